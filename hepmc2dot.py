@@ -1,13 +1,30 @@
 #!/usr/bin/env python
 
-import argparse
+import collections
+import itertools
 import math
-import re  # regex
+import os
+import struct
 import sys
 
+# modules only needed by some features (argparse, json, mmap, random, gzip, lzma, shlex, socket)
+# are imported where they are used, to keep the start-up of short invocations fast
+
+
+# levels of detail of the particle labels
+LABEL_NONE = 0
+LABEL_ID = 1
+LABEL_FULL = 2
+_label_details = {'none': LABEL_NONE, 'id': LABEL_ID, 'full': LABEL_FULL}
+
+# barcode offset of the vertices and particles added by the detector simulation, everything below
+# belongs to the primary (generator level) interaction
+PRIMARY_VTX_THRESHOLD = 200000
+
 
 def _get_dot_particle(prod_vtx_barcode, end_vtx_barcode,
-                      particle_barcode, particle_id, particle_energy, particle_pt, particle_eta):
+                      particle_barcode, particle_id, particle_energy, particle_pt, particle_eta,
+                      label_detail=LABEL_FULL):
     """
     Returns a string containing a DOT formatted edge which represents a particle travelling from
     the given production to the given end vertex. If end_vtx_barcode is None, the edge will connect
@@ -19,6 +36,33 @@ def _get_dot_particle(prod_vtx_barcode, end_vtx_barcode,
     else:
         end_vtx = _get_node_name(end_vtx_barcode)
 
+    attrib = _get_particle_attrib(particle_barcode, particle_id, particle_energy, particle_pt,
+                                  particle_eta, label_detail)
+    particle_dot = '    {prod_vtx} -> {end_vtx} [{attrib}];\n'.format(prod_vtx=prod_vtx,
+                                                                      end_vtx=end_vtx,
+                                                                      attrib=attrib)
+    return particle_dot
+
+
+def _get_compact_dot_particle(prod_node, end_node,
+                              particle_barcode, particle_id, particle_energy, particle_pt,
+                              particle_eta, label_detail=LABEL_FULL):
+    """
+    Returns the same edge as _get_dot_particle, between the given (short) node names and without
+    any optional whitespace or punctuation
+    """
+    attrib = _get_particle_attrib(particle_barcode, particle_id, particle_energy, particle_pt,
+                                  particle_eta, label_detail)
+    if attrib:
+        return '{0}->{1}[{2}]\n'.format(prod_node, end_node, attrib)
+    return '{0}->{1}\n'.format(prod_node, end_node)
+
+
+def _get_particle_attrib(particle_barcode, particle_id, particle_energy, particle_pt, particle_eta,
+                         label_detail=LABEL_FULL):
+    """
+    Returns the DOT attribute list (style and label) of the edge representing the given particle
+    """
     extra_attrib=""
     if abs(int(particle_id)) == 2212:
         #color protons in blue
@@ -30,18 +74,21 @@ def _get_dot_particle(prod_vtx_barcode, end_vtx_barcode,
         #color photons
         extra_attrib="fontcolor=brown,"
 
-    particle_dot = '    {prod_vtx} -> {end_vtx} [{extra_attrib}label="p #{bc}, ' \
-                   'id={part_id}\\n' \
-                   'pT={part_pt:.0f}, E={part_e:.0f}, &eta;={part_eta:.1f}"];\n' \
-                   .format(prod_vtx=prod_vtx,
-                           end_vtx=end_vtx,
-                           bc=particle_barcode,
-                           extra_attrib = extra_attrib,
-                           part_id=particle_id,
-                           part_pt=float(particle_pt),
-                           part_e=float(particle_energy),
-                           part_eta=float(particle_eta))
-    return particle_dot
+    if label_detail >= LABEL_FULL:
+        label = 'label="p #{bc}, ' \
+                'id={part_id}\\n' \
+                'pT={part_pt:.0f}, E={part_e:.0f}, &eta;={part_eta:.1f}"' \
+                .format(bc=particle_barcode,
+                        part_id=particle_id,
+                        part_pt=float(particle_pt),
+                        part_e=float(particle_energy),
+                        part_eta=float(particle_eta))
+    elif label_detail == LABEL_ID:
+        label = 'label="{part_id}"'.format(part_id=particle_id)
+    else:
+        # without label, the trailing separator of the style is not needed either
+        return extra_attrib[:-1]
+    return extra_attrib + label
 
 
 def _get_node_name(barcode, is_dummy=False):
@@ -84,76 +131,217 @@ def _get_dot_vertex(barcode, r, z, is_dummy=False, scale=1.):
     return dot
 
 
+def _get_compact_dot_vertex(node, r, z, is_dummy=False, scale=1.):
+    """
+    Returns the same node as _get_dot_vertex under the given (short) node name, relying on the
+    graph level node defaults written by HepDotWriter._begin_event
+    """
+    if is_dummy:
+        attrib = 'shape=none,'
+    else:
+        attrib = ''
+    return '{node}[{attrib}pos="{zpos:.3f},{rpos:.3f}!"]\n'.format(node=node,
+                                                                   attrib=attrib,
+                                                                   zpos=float(z) * scale,
+                                                                   rpos=float(r) * scale)
+
+
+def _parse_vertex(raw_hepmc_line):
+    """
+    Parses a 'V' record into a (barcode, x, y, z, number of orphan incoming particles) tuple
+    """
+    hepmc = raw_hepmc_line.split()
+    vtx_barcode_column = 1
+    x_column = 3
+    y_column = 4
+    z_column = 5
+    n_orphan_column = 7
+    return (int(hepmc[vtx_barcode_column]),
+            float(hepmc[x_column]),
+            float(hepmc[y_column]),
+            float(hepmc[z_column]),
+            int(hepmc[n_orphan_column]))
+
+
+def _parse_particle(raw_hepmc_line):
+    """
+    Parses a 'P' record into a (barcode, PDG id, px, py, pz, energy, end vertex barcode) tuple
+    """
+    line = raw_hepmc_line.split()
+    particle_barcode_column = 1
+    particle_id_column = 2
+    mom_x_column = 3
+    mom_y_column = 4
+    mom_z_column = 5
+    particle_energy_column = 6
+    end_vtx_barcode_column = 11
+    return (int(line[particle_barcode_column]),
+            int(line[particle_id_column]),
+            float(line[mom_x_column]),
+            float(line[mom_y_column]),
+            float(line[mom_z_column]),
+            float(line[particle_energy_column]),
+            int(line[end_vtx_barcode_column]))
+
+
+_compressed_suffixes = ('.gz', '.xz')
+
+
+def _open_dot_output(dotfile, append=False):
+    """
+    Opens the given DOT output file for writing (or appending) text, compressed according to its
+    extension
+    """
+    mode = 'a' if append else 'w'
+    # Python 2 has no text mode for compressed files, but its str is written as is
+    text_mode = 'b' if sys.version_info[0] < 3 else 't'
+    if dotfile.endswith('.gz'):
+        import gzip
+        return gzip.open(dotfile, mode + text_mode)
+    if dotfile.endswith('.xz'):
+        try:
+            import lzma
+        except ImportError:
+            raise ValueError('.xz output needs the lzma module of Python 3')
+        return lzma.open(dotfile, mode + text_mode)
+    return open(dotfile, mode)
+
+
+def _check_event_template(dotfile, manifest_file):
+    """
+    Raises ValueError if the given per-event file name template does not give every event its own
+    file, or if the default manifest location next to the files is not a single directory
+    """
+    try:
+        names = [dotfile.format(event=evt_num, index=evt_num) for evt_num in (0, 1)]
+    except (IndexError, KeyError, AttributeError, TypeError, ValueError) as err:
+        raise ValueError('per-event file name templates can only use the {event} and {index} '
+                         'fields, got %s (%s)' % (dotfile, err))
+    if names[0] == names[1]:
+        raise ValueError('per-event output needs an {event} or {index} field in the file '
+                         'name template, got %s' % dotfile)
+    if manifest_file is None and '{' in os.path.dirname(dotfile):
+        raise ValueError('per-event output into directories named by the template needs a '
+                         'manifest file, got %s' % dotfile)
+
+
+def _get_chunk_name(dotfile, chunk):
+    """
+    Returns the file name of the given numbered output chunk, e.g. 'graph.002.dot.gz' for chunk 2
+    of 'graph.dot.gz'
+    """
+    compression = ''
+    for suffix in _compressed_suffixes:
+        if dotfile.endswith(suffix):
+            compression = suffix
+            dotfile = dotfile[:-len(suffix)]
+    base, ext = os.path.splitext(dotfile)
+    return '{base}.{chunk:03d}{ext}{compression}'.format(base=base, chunk=chunk, ext=ext,
+                                                         compression=compression)
+
+
 class HepDotWriter(object):
     """
     Generates a dot file representing the given particles, interaction vertices and events
     """
 
-    def __init__(self, dotfile): #TODO: implement next:, vtx_threshold=np.nan, scale=1.):
-        self.dotfile = open(dotfile, 'w')
-
+    def __init__(self, dotfile, events_per_file=None, bytes_per_file=None,
+                 compact=False, label_detail=LABEL_FULL, per_event=False, manifest_file=None,
+                 vtx_threshold=None, scale=1., append=False):
+        # set up front, so that close() also works on a writer that failed to initialize
         self.event_open = False
+        self.dotfile = None
+        self.manifest = None
+        if per_event and (events_per_file or bytes_per_file):
+            raise ValueError('per-event output cannot be rotated')
+        if per_event:
+            _check_event_template(dotfile, manifest_file)
+
+        # output is compressed according to the file name (.gz or .xz) and, if a limit is given,
+        # rotated into numbered chunks at digraph boundaries, so each chunk renders on its own
+        self.dotfile_name = dotfile
+        self.events_per_file = events_per_file
+        self.bytes_per_file = bytes_per_file
+        self.chunk = 0
+        self.events_in_file = 0
+        self.bytes_in_file = 0
+
+        # in per-event mode, dotfile is a name template with {event} (event number) and {index}
+        # (running count) fields and every event goes to its own file, listed in the manifest
+        self.per_event = per_event
+        self.nodes_in_event = 0
+        self.event_num = None
+        self.event_file_name = None
+        if per_event:
+            if manifest_file is None:
+                manifest_file = os.path.join(os.path.dirname(dotfile), 'manifest.tsv')
+            self.manifest = open(manifest_file, 'w')
+            self.manifest.write('event\tfile\tnodes\tbytes\n')
+        else:
+            self.dotfile = _open_dot_output(self._get_output_name(), append)
+
+        # the compact profile declares the node defaults once per digraph and uses short
+        # per-event node names instead of the barcode based ones
+        self.compact = compact
+        self.label_detail = label_detail
+        self.node_names = {}
+
         self.cur_vtx_barcode = None
         self.cur_vtx_r = None
         self.cur_vtx_z = None
+        self.cur_vtx_skipped = False
 
-        # TODO: implement next:
-        # self.vtx_threshold = np.nan # vtx_threshold
-        self.scale = 1.  # scale
+        # vertices with barcodes above the threshold (and particles ending in them) are skipped
         # primary only:
-        #self.vtx_threshold = 200000
-        #self.scale = 50.
+        #vtx_threshold = PRIMARY_VTX_THRESHOLD
+        #scale = 50.
         # all particles:
-        #self.vtx_threshold = np.nan
-        #self.scale = 2.
+        #vtx_threshold = None
+        #scale = 2.
+        self.vtx_threshold = vtx_threshold
+        self.scale = scale
 
     def start_new_event(self, raw_hepmc_line):
         self._end_opened_event()
         self._begin_event(raw_hepmc_line)
 
     def start_new_vertex(self, raw_hepmc_line):
-        hepmc = raw_hepmc_line.split()
-        vtx_barcode_column = 1
-        vtx_barcode = int(hepmc[vtx_barcode_column])
-        # TODO: implement next
-        #vtx_abs_barcode = abs(vtx_barcode)
-        #if vtx_abs_barcode > self.vtx_threshold:
-        #    return
-
-        x_column = 3
-        x = float(hepmc[x_column])
-        y_column = 4
-        y = float(hepmc[y_column])
-        z_column = 5
-
-        self.cur_vtx_z = float(hepmc[z_column])
-        self.cur_vtx_r = math.sqrt(x**2 + y**2)
-
-        self.cur_vtx_barcode = vtx_barcode
-        dot_vtx = _get_dot_vertex(vtx_barcode,
-                                  self.cur_vtx_r,
-                                  self.cur_vtx_z,
-                                  scale=self.scale)
-        self.dotfile.write(dot_vtx)
+        self.add_vertex(_parse_vertex(raw_hepmc_line))
 
     def add_outgoing_particle(self, raw_hepmc_line):
-        line = raw_hepmc_line.split()
+        self.add_particle(_parse_particle(raw_hepmc_line))
 
-        particle_barcode_column = 1
-        particle_barcode = line[particle_barcode_column]
+    def add_vertex(self, vertex):
+        """
+        Writes the given vertex record, as returned by _parse_vertex
+        """
+        vtx_barcode, x, y, z, _ = vertex
+        vtx_abs_barcode = abs(vtx_barcode)
+        self.cur_vtx_skipped = (self.vtx_threshold is not None and
+                                vtx_abs_barcode > self.vtx_threshold)
+        if self.cur_vtx_skipped:
+            return
 
-        particle_id_column = 2
-        particle_id = line[particle_id_column]
+        self.cur_vtx_z = z
+        self.cur_vtx_r = math.sqrt(x**2 + y**2)
 
-        particle_energy_column = 6
-        particle_energy = float(line[particle_energy_column])
+        self.cur_vtx_barcode = vtx_barcode
+        self.nodes_in_event = self.nodes_in_event + 1
+        dot_vtx = self._format_vertex(vtx_barcode,
+                                      self.cur_vtx_r,
+                                      self.cur_vtx_z,
+                                      scale=self.scale)
+        self._write(dot_vtx)
 
-        mom_x_column = 3
-        mom_x = float(line[mom_x_column])
-        mom_y_column = 4
-        mom_y = float(line[mom_y_column])
-        mom_z_column = 5
-        mom_z = float(line[mom_z_column])
+    def add_particle(self, particle):
+        """
+        Writes the given particle record, as returned by _parse_particle, as outgoing particle of
+        the current vertex
+        """
+        if self.cur_vtx_skipped:
+            return
+        particle_barcode, particle_id, mom_x, mom_y, mom_z, particle_energy, end_vtx_barcode = \
+            particle
 
         mom_r = math.sqrt(mom_x**2 + mom_y**2)
         mom_abs = math.sqrt(mom_r**2 + mom_z**2)
@@ -165,12 +353,10 @@ class HepDotWriter(object):
             particle_eta = 0.5 * math.log( peta_num / peta_den )
         particle_pt = mom_r
 
-        end_vtx_barcode_column = 11
-        end_vtx_barcode = abs(int(line[end_vtx_barcode_column]))
+        end_vtx_barcode = abs(end_vtx_barcode)
 
-        # TODO: implement next
-        #if end_vtx_barcode > self.vtx_threshold:
-        #    return
+        if self.vtx_threshold is not None and end_vtx_barcode > self.vtx_threshold:
+            return
 
         if not end_vtx_barcode:
             # create dummy end node for partiles that don't have end vertices
@@ -180,39 +366,166 @@ class HepDotWriter(object):
             end_vtx_r = self.cur_vtx_r * self.scale + mom_r / mom_abs * particle_len
             end_vtx_z = self.cur_vtx_z * self.scale + mom_z / mom_abs * particle_len
 
-            dot_vtx = _get_dot_vertex(particle_barcode,
-                                      end_vtx_r,
-                                      end_vtx_z,
-                                      is_dummy=True)
-            self.dotfile.write(dot_vtx)
-
-        particle_dot = _get_dot_particle(self.cur_vtx_barcode,
-                                         end_vtx_barcode,
-                                         particle_barcode,
-                                         particle_id,
-                                         particle_energy,
-                                         particle_pt,
-                                         particle_eta)
-        self.dotfile.write(particle_dot)
+            self.nodes_in_event = self.nodes_in_event + 1
+            dot_vtx = self._format_vertex(particle_barcode,
+                                          end_vtx_r,
+                                          end_vtx_z,
+                                          is_dummy=True)
+            self._write(dot_vtx)
+
+        particle_dot = self._format_particle(self.cur_vtx_barcode,
+                                             end_vtx_barcode,
+                                             particle_barcode,
+                                             particle_id,
+                                             particle_energy,
+                                             particle_pt,
+                                             particle_eta)
+        self._write(particle_dot)
+
+    def add_rendered_event(self, evt_num, dot, n_nodes):
+        """
+        Writes a complete event (digraph) with the given number of nodes, as rendered before by a
+        writer with the same output options
+        """
+        self._end_opened_event()
+        self._open_event_output(evt_num)
+        self.nodes_in_event = n_nodes
+        self._write(dot)
+        if self.per_event:
+            self._end_event_file()
+
+    def get_output_options(self):
+        """
+        Returns the options that determine the DOT text of an event
+        """
+        return dict(compact=self.compact, label_detail=self.label_detail,
+                    vtx_threshold=self.vtx_threshold, scale=self.scale)
+
+    def finish_event(self):
+        """
+        Terminates the currently open event, so that the output ends on a digraph boundary.
+        """
+        self._end_opened_event()
+
+    def flush(self):
+        """
+        Flushes the output file and returns its current size.
+        """
+        self.dotfile.flush()
+        return self.dotfile.tell()
 
     def close(self):
         """
         Terminates the currently open event and closes the output file.
         """
         self._end_opened_event()
-        self.dotfile.close()
+        if self.dotfile is not None:
+            self.dotfile.close()
+        if self.manifest is not None:
+            self.manifest.close()
 
     def __del__(self):
         self.close()
 
     def _begin_event(self, raw_hepmc_line):
-        self.event_open = True
         evt_num_column = 1
         evt_num = raw_hepmc_line.split()[evt_num_column]
-        self.dotfile.write("digraph event_%s {\n" % evt_num)
+        self._open_event_output(evt_num)
+        self.event_open = True
+        self.nodes_in_event = 0
+        self._write("digraph event_%s {\n" % evt_num)
+        if self.compact:
+            self.node_names = {}
+            self._write('node[shape=point,label=""]\n')
+
+    def _open_event_output(self, evt_num):
+        if self.per_event:
+            # as a number, so that the template can format it, e.g. zero-padded with {event:05d}
+            self._start_event_file(int(evt_num))
+        elif self._is_chunk_full():
+            self._start_new_chunk()
+        self.events_in_file = self.events_in_file + 1
 
     def _end_event(self):
-        self.dotfile.write("}\n")
+        self._write("}\n")
+        if self.per_event:
+            self._end_event_file()
+
+    def _format_vertex(self, barcode, r, z, is_dummy=False, scale=1.):
+        if not self.compact:
+            return _get_dot_vertex(barcode, r, z, is_dummy=is_dummy, scale=scale)
+        return _get_compact_dot_vertex(self._get_short_node_name(barcode, is_dummy),
+                                       r, z, is_dummy=is_dummy, scale=scale)
+
+    def _format_particle(self, prod_vtx_barcode, end_vtx_barcode,
+                         particle_barcode, particle_id, particle_energy, particle_pt, particle_eta):
+        if not self.compact:
+            return _get_dot_particle(prod_vtx_barcode, end_vtx_barcode,
+                                     particle_barcode, particle_id, particle_energy, particle_pt,
+                                     particle_eta, label_detail=self.label_detail)
+        prod_node = self._get_short_node_name(prod_vtx_barcode)
+        if not end_vtx_barcode:
+            end_node = self._get_short_node_name(particle_barcode, is_dummy=True)
+        else:
+            end_node = self._get_short_node_name(end_vtx_barcode)
+        return _get_compact_dot_particle(prod_node, end_node,
+                                         particle_barcode, particle_id, particle_energy,
+                                         particle_pt, particle_eta, self.label_detail)
+
+    def _get_short_node_name(self, barcode, is_dummy=False):
+        key = (is_dummy, abs(int(barcode)))
+        node_name = self.node_names.get(key)
+        if node_name is None:
+            node_name = 'n%d' % len(self.node_names)
+            self.node_names[key] = node_name
+        return node_name
+
+    def _write(self, dot):
+        if self.dotfile is None:
+            # per-event mode, outside of any event
+            return
+        self.bytes_in_file = self.bytes_in_file + len(dot)
+        self.dotfile.write(dot)
+
+    def _start_event_file(self, evt_num):
+        self.event_file_name = self.dotfile_name.format(event=evt_num, index=self.chunk)
+        self.event_num = evt_num
+        # the template may also name the directory of each event
+        event_dir = os.path.dirname(self.event_file_name)
+        if event_dir and not os.path.isdir(event_dir):
+            os.makedirs(event_dir)
+        self.dotfile = _open_dot_output(self.event_file_name)
+
+    def _end_event_file(self):
+        self.dotfile.close()
+        self.dotfile = None
+        self.chunk = self.chunk + 1
+        self.manifest.write('{event}\t{name}\t{nodes}\t{size}\n'.format(
+            event=self.event_num,
+            name=self.event_file_name,
+            nodes=self.nodes_in_event,
+            size=os.path.getsize(self.event_file_name)))
+
+    def _is_chunk_full(self):
+        if not self.events_in_file:
+            return False
+        if self.events_per_file and self.events_in_file >= self.events_per_file:
+            return True
+        if self.bytes_per_file and self.bytes_in_file >= self.bytes_per_file:
+            return True
+        return False
+
+    def _start_new_chunk(self):
+        self.dotfile.close()
+        self.chunk = self.chunk + 1
+        self.events_in_file = 0
+        self.bytes_in_file = 0
+        self.dotfile = _open_dot_output(self._get_output_name())
+
+    def _get_output_name(self):
+        if not (self.events_per_file or self.bytes_per_file):
+            return self.dotfile_name
+        return _get_chunk_name(self.dotfile_name, self.chunk)
 
     def _end_opened_event(self):
         if self.event_open:
@@ -220,58 +533,1090 @@ class HepDotWriter(object):
         self.event_open = False
 
 
+class HepEventIndex(object):
+    """
+    Forward and backward adjacency of the vertices and particles of a single event, built from
+    the parsed 'V' and 'P' records. Vertex barcodes are negative and particle barcodes are positive,
+    as in the HepMC record, so a mixed list of seed barcodes can be used for the extraction.
+    """
+
+    def __init__(self):
+        self.vertices = {}
+        self.vertex_order = {}
+        self.particles = {}
+        # particles listed after each 'V' record, i.e. those the writer attaches to that vertex
+        self.hosted = {}
+        self.outgoing = {}
+        self.incoming = {}
+        self.particle_host = {}
+        self.particle_prod = {}
+        self.particle_end = {}
+
+        self._cur_vtx_barcode = None
+        self._orphans_left = 0
+
+    def add_vertex(self, vertex):
+        vtx_barcode = vertex[0]
+        self._orphans_left = vertex[4]
+
+        self.vertices[vtx_barcode] = vertex
+        self.vertex_order[vtx_barcode] = len(self.vertex_order)
+        self.hosted[vtx_barcode] = []
+        self.outgoing.setdefault(vtx_barcode, [])
+        self.incoming.setdefault(vtx_barcode, [])
+        self._cur_vtx_barcode = vtx_barcode
+
+    def add_particle(self, particle):
+        if self._cur_vtx_barcode is None:
+            # particle without any preceding vertex, nothing to attach it to
+            return
+
+        particle_barcode = particle[0]
+        end_vtx_barcode = particle[6]
+
+        host = self._cur_vtx_barcode
+        if self._orphans_left > 0:
+            # orphan incoming particles come first and have no production vertex in the event
+            self._orphans_left -= 1
+            prod_vtx_barcode = None
+        else:
+            prod_vtx_barcode = host
+            self.outgoing[host].append(particle_barcode)
+
+        self.particles[particle_barcode] = particle
+        self.hosted[host].append(particle_barcode)
+        self.particle_host[particle_barcode] = host
+        self.particle_prod[particle_barcode] = prod_vtx_barcode
+        if end_vtx_barcode:
+            self.particle_end[particle_barcode] = end_vtx_barcode
+            self.incoming.setdefault(end_vtx_barcode, []).append(particle_barcode)
+
+    def descendants(self, seeds, max_depth=None):
+        """
+        Returns the (vertex barcodes, particle barcodes) sets reachable downstream of the given
+        seeds, up to max_depth particle generations below them.
+        """
+        return self._walk(seeds, max_depth, self.particle_end, self.outgoing)
+
+    def ancestors(self, seeds, max_depth=None):
+        """
+        Returns the (vertex barcodes, particle barcodes) sets reachable upstream of the given
+        seeds, up to max_depth particle generations above them.
+        """
+        return self._walk(seeds, max_depth, self.particle_prod, self.incoming)
+
+    def replay(self, vertices, particles, writer):
+        """
+        Feeds the selected vertices and particles to the given writer in their original order.
+        Only the selection is touched, so the cost scales with its size and not the event's.
+        """
+        nodes = set(vertices)
+        for particle_barcode in particles:
+            nodes.add(self.particle_host[particle_barcode])
+            end_vtx_barcode = self.particle_end.get(particle_barcode)
+            if end_vtx_barcode in self.vertices:
+                nodes.add(end_vtx_barcode)
+
+        for vtx_barcode in sorted(nodes, key=self.vertex_order.get):
+            writer.add_vertex(self.vertices[vtx_barcode])
+            for particle_barcode in self.hosted[vtx_barcode]:
+                if particle_barcode in particles:
+                    writer.add_particle(self.particles[particle_barcode])
+
+    def _walk(self, seeds, max_depth, next_vertex, vertex_particles):
+        vertices = set()
+        particles = set()
+        queue = collections.deque()
+        for barcode in seeds:
+            barcode = int(barcode)
+            if barcode < 0 and barcode in self.vertices:
+                queue.append((barcode, 0, True))
+            elif barcode > 0 and barcode in self.particles:
+                queue.append((barcode, 0, False))
+
+        while queue:
+            barcode, depth, is_vertex = queue.popleft()
+            if is_vertex:
+                if barcode in vertices:
+                    continue
+                vertices.add(barcode)
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                for particle_barcode in vertex_particles.get(barcode, ()):
+                    queue.append((particle_barcode, depth + 1, False))
+            else:
+                if barcode in particles:
+                    continue
+                particles.add(barcode)
+                vtx_barcode = next_vertex.get(barcode)
+                if vtx_barcode in self.vertices:
+                    queue.append((vtx_barcode, depth, True))
+
+        return vertices, particles
+
+
+class HepSubgraphWriter(object):
+    """
+    Writes only the decay chains (descendants) or histories (ancestors) of the given seed
+    barcodes, by indexing each event and forwarding the selected records to a HepDotWriter
+    """
+
+    def __init__(self, dotfile, seeds, ancestors=False, max_depth=None, **writer_options):
+        # set up front, so that close() also works on a writer that failed to initialize
+        self.index = None
+        self.writer = None
+        self.writer = HepDotWriter(dotfile, **writer_options)
+        self.seeds = [int(seed) for seed in seeds]
+        self.ancestors = ancestors
+        self.max_depth = max_depth
+
+    def start_new_event(self, raw_hepmc_line):
+        self._flush_event()
+        self.writer.start_new_event(raw_hepmc_line)
+        self.index = HepEventIndex()
+
+    def start_new_vertex(self, raw_hepmc_line):
+        self.add_vertex(_parse_vertex(raw_hepmc_line))
+
+    def add_outgoing_particle(self, raw_hepmc_line):
+        self.add_particle(_parse_particle(raw_hepmc_line))
+
+    def add_vertex(self, vertex):
+        if self.index is not None:
+            self.index.add_vertex(vertex)
+
+    def add_particle(self, particle):
+        if self.index is not None:
+            self.index.add_particle(particle)
+
+    def finish_event(self):
+        """
+        Writes out and terminates the currently open event.
+        """
+        self._flush_event()
+        self.writer.finish_event()
+
+    def flush(self):
+        """
+        Flushes the output file and returns its current size.
+        """
+        return self.writer.flush()
+
+    def close(self):
+        """
+        Writes out the currently open event and closes the output file.
+        """
+        self._flush_event()
+        if self.writer is not None:
+            self.writer.close()
+
+    def __del__(self):
+        self.close()
+
+    def _flush_event(self):
+        if self.index is None:
+            return
+        if self.ancestors:
+            vertices, particles = self.index.ancestors(self.seeds, self.max_depth)
+        else:
+            vertices, particles = self.index.descendants(self.seeds, self.max_depth)
+        self.index.replay(vertices, particles, self.writer)
+        self.index = None
+
+
+class HepStatsWriter(object):
+    """
+    Writes a tab-separated table with the number of vertices, particles and final state particles
+    and the final state energy of each event
+    """
+
+    def __init__(self, statsfile):
+        self.statsfile = open(statsfile, 'w')
+        self.statsfile.write('event\tvertices\tparticles\tfinal_state\tfinal_state_energy\n')
+        self.event_open = False
+        self.event_num = None
+        self.n_vertices = 0
+        self.n_particles = 0
+        self.n_final_state = 0
+        self.final_state_energy = 0.
+
+    def start_new_event(self, raw_hepmc_line):
+        self._end_opened_event()
+        evt_num_column = 1
+        self.event_num = raw_hepmc_line.split()[evt_num_column]
+        self.event_open = True
+        self.n_vertices = 0
+        self.n_particles = 0
+        self.n_final_state = 0
+        self.final_state_energy = 0.
+
+    def start_new_vertex(self, raw_hepmc_line):
+        self.add_vertex(_parse_vertex(raw_hepmc_line))
+
+    def add_outgoing_particle(self, raw_hepmc_line):
+        self.add_particle(_parse_particle(raw_hepmc_line))
+
+    def add_vertex(self, vertex):
+        self.n_vertices = self.n_vertices + 1
+
+    def add_particle(self, particle):
+        self.n_particles = self.n_particles + 1
+        end_vtx_barcode = particle[6]
+        if not end_vtx_barcode:
+            particle_energy = particle[5]
+            self.n_final_state = self.n_final_state + 1
+            self.final_state_energy = self.final_state_energy + particle_energy
+
+    def close(self):
+        """
+        Writes the row of the currently open event and closes the output file.
+        """
+        self._end_opened_event()
+        self.statsfile.close()
+
+    def _end_opened_event(self):
+        if self.event_open:
+            self.statsfile.write('{0}\t{1}\t{2}\t{3}\t{4:.3f}\n'.format(self.event_num,
+                                                                        self.n_vertices,
+                                                                        self.n_particles,
+                                                                        self.n_final_state,
+                                                                        self.final_state_energy))
+        self.event_open = False
+
+
+class HepMultiWriter(object):
+    """
+    Feeds every record to several writers, so that a single parsing pass produces all of their
+    outputs. Each record is parsed once, no matter how many writers consume it.
+    """
+
+    def __init__(self, writers):
+        self.writers = list(writers)
+
+    def start_new_event(self, raw_hepmc_line):
+        for writer in self.writers:
+            writer.start_new_event(raw_hepmc_line)
+
+    def start_new_vertex(self, raw_hepmc_line):
+        self.add_vertex(_parse_vertex(raw_hepmc_line))
+
+    def add_outgoing_particle(self, raw_hepmc_line):
+        self.add_particle(_parse_particle(raw_hepmc_line))
+
+    def add_vertex(self, vertex):
+        for writer in self.writers:
+            writer.add_vertex(vertex)
+
+    def add_particle(self, particle):
+        for writer in self.writers:
+            writer.add_particle(particle)
+
+    def close(self):
+        """
+        Closes all writers.
+        """
+        for writer in self.writers:
+            writer.close()
+
+
 def main(argv):
     """
     Parses the given command line arguments and runs the conversion from the specified
     input HepMC::IO_GenEvent to the specified DOT output file
+
+    With '--serve [SOCKET]' as arguments, conversion jobs are read from the standard input or
+    the given Unix socket instead, see serve().
     """
+    if argv[:1] == ['--serve']:
+        serve(*argv[1:2])
+        return
+    args = _get_parser().parse_args(argv)
+    _run(args)
+
+
+_parser = None
+
+
+def _get_parser():
+    """
+    Returns the command line parser, which is only built once per process
+    """
+    global _parser
+    if _parser is not None:
+        return _parser
+
+    import argparse
     parser = argparse.ArgumentParser(
-        description='Convert HepMC::IO_GenEvent ASCII files into DOT files')
+        description='Convert HepMC::IO_GenEvent ASCII files into DOT files',
+        epilog='Run with --serve [SOCKET] to process conversion jobs, one command line per line, '
+               'from the standard input or a Unix socket.')
     parser.add_argument('hepmcfile',
                         help='input HepMC::IO_GenEvent formatted ASCII file')
-    parser.add_argument('dotfile', help='output DOT file')
+    parser.add_argument('dotfile', help='output DOT file, compressed if ending in .gz or .xz')
     parser.add_argument('nevents', type=int, default=-1, nargs='?', help='Process only this number of events')
     parser.add_argument('skip', type=int, default=0, nargs='?', help='Skip the given number of events at the start')
-    args = parser.parse_args(argv)
-    convert(args.hepmcfile, args.dotfile, args.nevents, args.skip)
+    parser.add_argument('--seed', type=int, action='append', dest='seeds', metavar='BARCODE',
+                        help='Only write the decay chain of this particle (positive) or '
+                             'vertex (negative) barcode, can be given several times')
+    parser.add_argument('--ancestors', action='store_true',
+                        help='Write the history of the seeds instead of their decay chain')
+    parser.add_argument('--depth', type=int, default=None,
+                        help='Follow the seeds for at most this number of particle generations')
+    sampling = parser.add_mutually_exclusive_group()
+    sampling.add_argument('--stride', type=int, default=1, metavar='N',
+                          help='Only convert every N-th event')
+    sampling.add_argument('--sample', type=int, default=None, metavar='K',
+                          help='Only convert K events chosen uniformly at random')
+    parser.add_argument('--sample-seed', type=int, default=None,
+                        help='Random seed for --sample, for reproducible samples')
+    parser.add_argument('--events-per-file', type=int, default=None, metavar='N',
+                        help='Rotate the output into numbered files of N events each')
+    parser.add_argument('--bytes-per-file', type=int, default=None, metavar='BYTES',
+                        help='Start a new numbered output file once this size is reached')
+    parser.add_argument('--compact', action='store_true',
+                        help='Write smaller DOT files with graph level defaults and short node '
+                             'names')
+    parser.add_argument('--label-detail', choices=sorted(_label_details), default='full',
+                        help='Level of detail of the particle labels')
+    parser.add_argument('--per-event', action='store_true',
+                        help='Write each event to its own file, dotfile being a name template '
+                             'with {event} and {index} fields, e.g. "out/event_{event}.dot"')
+    parser.add_argument('--manifest', default=None,
+                        help='Index of the per-event files (default: manifest.tsv next to them)')
+    parser.add_argument('--cache', default=None, metavar='CACHEFILE',
+                        help='Read the events from this binary cache of the input file, '
+                             'which is built on the first use and whenever the input changes')
+    parser.add_argument('--vtx-threshold', type=int, default=None, metavar='BARCODE',
+                        help='Skip vertices with absolute barcodes above this threshold')
+    parser.add_argument('--primary', default=None, metavar='DOTFILE',
+                        help='Also write the primary interaction only (vertex barcodes up to '
+                             '%d) to this DOT file' % PRIMARY_VTX_THRESHOLD)
+    parser.add_argument('--stats', default=None, metavar='STATSFILE',
+                        help='Also write a table of per-event statistics to this file')
+    parser.add_argument('--checkpoint-every', type=int, default=None, metavar='N',
+                        help='Record the progress every N events, to allow resuming')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted conversion from its last checkpoint')
+    _parser = parser
+    return parser
 
 
-def convert(hepmc_file, dot_file, max_events, skip_events):
+def _run(args, verbose=True):
+    """
+    Runs the conversion described by the given parsed command line arguments and returns the
+    number of converted events
+    """
+    return convert(args.hepmcfile, args.dotfile, args.nevents, args.skip,
+                   seeds=args.seeds, ancestors=args.ancestors, max_depth=args.depth,
+                   stride=args.stride, sample=args.sample, sample_seed=args.sample_seed,
+                   events_per_file=args.events_per_file, bytes_per_file=args.bytes_per_file,
+                   compact=args.compact, label_detail=_label_details[args.label_detail],
+                   per_event=args.per_event, manifest_file=args.manifest,
+                   cache_file=args.cache, vtx_threshold=args.vtx_threshold,
+                   primary_file=args.primary, stats_file=args.stats,
+                   checkpoint_interval=args.checkpoint_every, resume=args.resume,
+                   verbose=verbose)
+
+
+def serve(socket_path=None):
+    """
+    Runs conversion jobs until stopped, so that the interpreter start-up is only paid once.
+
+    Each job is one command line, with the same arguments as hepmc2dot.py, and is answered by a
+    line 'ok <number of events>' or 'error <message>'. Jobs are read from the standard input or,
+    if socket_path is given, from the connections to a Unix socket at that path. The job 'quit'
+    stops the server.
+    """
+    if socket_path is None:
+        serve_jobs(sys.stdin, sys.stdout)
+        return
+
+    import socket
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+    try:
+        running = True
+        while running:
+            connection, _ = server.accept()
+            stream = connection.makefile('rw')
+            try:
+                running = serve_jobs(stream, stream)
+            finally:
+                stream.close()
+                connection.close()
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def serve_jobs(jobs, replies):
+    """
+    Runs the conversion jobs read from the given lines and writes one reply line for each of them.
+    Returns False if the job 'quit' was received, True if the jobs ran out.
+    """
+    import shlex
+    # readline instead of iterating, which reads ahead on Python 2 and would keep a client that
+    # waits for each reply waiting forever
+    for job in iter(jobs.readline, ''):
+        job = job.strip()
+        if not job:
+            continue
+        if job == 'quit':
+            return False
+        # nothing but the replies may reach the reply stream, which can be the standard output
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            n_events = _run(_get_parser().parse_args(shlex.split(job)), verbose=False)
+            replies.write('ok %d\n' % n_events)
+        except SystemExit as err:
+            if err.code:
+                # argparse already explained the problem on stderr
+                replies.write('error invalid arguments\n')
+            else:
+                # the help was requested, and written to stderr
+                replies.write('ok 0\n')
+        except Exception as err:  # pylint: disable=broad-except
+            replies.write('error %s\n' % err)
+        finally:
+            sys.stdout = stdout
+        replies.flush()
+    return True
+
+
+def convert(hepmc_file, dot_file, max_events, skip_events,
+            seeds=None, ancestors=False, max_depth=None,
+            stride=1, sample=None, sample_seed=None,
+            events_per_file=None, bytes_per_file=None,
+            compact=False, label_detail=LABEL_FULL, per_event=False, manifest_file=None,
+            cache_file=None, vtx_threshold=None, scale=1., primary_file=None, stats_file=None,
+            extra_writers=(), checkpoint_interval=None, resume=False, checkpoint_file=None,
+            verbose=True):
     """
     Converts the given HepMC::IO_GenEvent formatted file into a DOT formatted file
+
+    If seeds are given, only their descendants (or ancestors) are written for each event.
+    After skipping skip_events, either every stride-th event is written or, if sample is given,
+    that many events drawn uniformly at random (reproducible with sample_seed).
+    A '.gz' or '.xz' dot_file is compressed, and events_per_file or bytes_per_file rotate the
+    output into numbered chunks. compact selects the compact output profile and label_detail
+    the level of detail of the particle labels. With per_event, dot_file is a name template such
+    as 'event_{event}.dot' and each event is written to its own file, listed in manifest_file.
+    If cache_file is given, the events are read from that binary cache, which is (re)built
+    first if it is missing or out of date, and the DOT text of the events rendered with the same
+    output options is copied from cache_file + '.rendered'. Only vertices up to vtx_threshold
+    are written, with positions multiplied by scale. From the same parsing pass, primary_file
+    receives the primary interaction only and stats_file per-event statistics, and the events
+    are also fed to the given extra_writers, which are closed at the end.
+    With checkpoint_interval, the progress is recorded every that many events in checkpoint_file
+    (by default dot_file + '.checkpoint'), and resume continues from the last checkpoint.
+    Returns the number of converted events.
+    """
+    # every writer, including those that fail validation below, is closed at the end
+    writers = list(extra_writers)
+    try:
+        if stride < 1:
+            raise ValueError('stride must be at least 1, got %d' % stride)
+        if sample is not None and stride != 1:
+            raise ValueError('stride and sample cannot be combined')
+
+        checkpointing = checkpoint_interval or resume
+        if checkpointing and (cache_file is not None or sample is not None or extra_writers or
+                              primary_file or stats_file or per_event or events_per_file or
+                              bytes_per_file or dot_file.endswith(_compressed_suffixes)):
+            raise ValueError('checkpoints need a single uncompressed DOT output and the text '
+                             'input')
+        if checkpoint_file is None:
+            checkpoint_file = dot_file + '.checkpoint'
+        # the options that select and format the events, a resumed conversion must use the same
+        options = dict(max_events=max_events, skip_events=skip_events, stride=stride,
+                       seeds=[int(seed) for seed in seeds or ()], ancestors=ancestors,
+                       max_depth=max_depth, compact=compact, label_detail=label_detail,
+                       vtx_threshold=vtx_threshold, scale=scale)
+        state = None
+        if resume and os.path.exists(checkpoint_file):
+            state = HepCheckpointer.load(checkpoint_file, hepmc_file, options)
+            if not os.path.exists(dot_file) or os.path.getsize(dot_file) < state['output_offset']:
+                raise ValueError('%s is missing or shorter than recorded in %s'
+                                 % (dot_file, checkpoint_file))
+            # drop whatever was written after the checkpoint, including a partial digraph
+            with open(dot_file, 'r+b') as dot:
+                dot.truncate(state['output_offset'])
+            if not checkpoint_interval:
+                checkpoint_interval = state['interval']
+
+        writer_options = dict(events_per_file=events_per_file, bytes_per_file=bytes_per_file,
+                              compact=compact, label_detail=label_detail,
+                              per_event=per_event, manifest_file=manifest_file,
+                              vtx_threshold=vtx_threshold, scale=scale,
+                              append=state is not None)
+        if seeds:
+            dot = HepSubgraphWriter(dot_file, seeds, ancestors=ancestors, max_depth=max_depth,
+                                    **writer_options)
+        else:
+            dot = HepDotWriter(dot_file, **writer_options)
+        writers.insert(0, dot)
+        # the additional products are only opened, and their files truncated, once the main
+        # output is set up
+        if primary_file:
+            writers.append(HepDotWriter(primary_file, vtx_threshold=PRIMARY_VTX_THRESHOLD,
+                                        scale=50.))
+        if stats_file:
+            writers.append(HepStatsWriter(stats_file))
+        if len(writers) > 1:
+            dot = HepMultiWriter(writers)
+
+        if cache_file is not None:
+            n_events = _convert_cached(hepmc_file, cache_file, dot, max_events, skip_events,
+                                       stride, sample, sample_seed)
+        elif checkpointing:
+            n_events = _convert_checkpointed(hepmc_file, checkpoint_file, checkpoint_interval,
+                                             state, options, dot)
+        elif sample is not None:
+            # the skipped events are already excluded from the drawn sample
+            offsets = _sample_event_offsets(hepmc_file, sample, skip_events, sample_seed)
+            n_events = _convert_lines(_iter_event_lines(hepmc_file, offsets), dot, max_events,
+                                      0, stride)
+        else:
+            with open(hepmc_file, 'r') as hepmc:
+                n_events = _convert_lines(hepmc, dot, max_events, skip_events, stride)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    if verbose:
+        print("Converted %d events." % n_events)
+    return n_events
+
+
+def _convert_lines(lines, dot, max_events, skip_events, stride=1, counters=(0, 0, 0),
+                   on_event_boundary=None):
+    """
+    Feeds the events of the given HepMC lines to the writer and returns the number of events
+
+    counters are the (converted, skipped, candidate) event counters to start from, and
+    on_event_boundary is called with their current values before each 'E' record.
+    """
+    n_events, skipped_events, candidate_events = counters
+    skipping_event = False
+    for line in lines:
+        if line.startswith('E '):
+            if on_event_boundary is not None:
+                on_event_boundary(n_events, skipped_events, candidate_events)
+            if (skipped_events < skip_events):
+                # need to skip this event
+                skipped_events = skipped_events + 1
+                skipping_event = True
+                continue
+            else:
+                # done skipping events! Continue with normal processing
+                skipping_event = False
+            if (max_events >= 0) and (n_events >= max_events):
+                break; # Stop processing events
+            candidate_events = candidate_events + 1
+            if (candidate_events - 1) % stride:
+                # not on the stride, don't spend any time formatting this event
+                skipping_event = True
+                continue
+            dot.start_new_event(line)
+            n_events = n_events + 1
+        elif line.startswith('V '):
+            if not skipping_event:
+                dot.start_new_vertex(line)
+        elif line.startswith('P '):
+            if not skipping_event:
+                dot.add_outgoing_particle(line)
+        # ignore unknown lines
+    return n_events
+
+
+def _convert_checkpointed(hepmc_file, checkpoint_file, checkpoint_interval, state, options,
+                          dot):
+    """
+    Feeds the events of the given file to the writer like _convert_lines, starting from the given
+    checkpoint state (if any) and recording new checkpoints along the way, together with the
+    conversion options. The checkpoint file is removed once the conversion is complete.
+    """
+    input_offset = 0
+    counters = (0, 0, 0)
+    if state is not None:
+        input_offset = state['input_offset']
+        counters = (state['n_events'], state['skipped_events'], state['candidate_events'])
+    with open(hepmc_file, 'rb') as hepmc:
+        reader = _LineReader(hepmc, input_offset)
+        checkpointer = HepCheckpointer(checkpoint_file, checkpoint_interval, hepmc_file, reader,
+                                       dot, options)
+        n_events = _convert_lines(reader, dot, options['max_events'], options['skip_events'],
+                                  options['stride'], counters, on_event_boundary=checkpointer)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return n_events
+
+
+class _LineReader(object):
+    """
+    Iterates over the decoded lines of a file opened in binary mode, from the given byte offset,
+    keeping track of the offset of the current line
+    """
+
+    def __init__(self, hepmc, offset=0):
+        self.hepmc = hepmc
+        self.hepmc.seek(offset)
+        self.offset = offset
+        self.next_offset = offset
+
+    def __iter__(self):
+        for line in self.hepmc:
+            self.offset = self.next_offset
+            self.next_offset = self.next_offset + len(line)
+            yield line.decode()
+
+
+class HepCheckpointer(object):
+    """
+    Records the progress of a conversion in a checkpoint file every interval events. Checkpoints
+    are only taken at event boundaries, after terminating the open digraph, so the output up to
+    the recorded position is always complete.
+    """
+
+    def __init__(self, checkpoint_file, interval, hepmc_file, reader, dot, options):
+        self.checkpoint_file = checkpoint_file
+        self.interval = interval
+        self.reader = reader
+        self.dot = dot
+        self.options = options
+        self.source_size, self.source_mtime = _get_source_stamp(hepmc_file)
+        self.n_boundaries = 0
+
+    def __call__(self, n_events, skipped_events, candidate_events):
+        self.n_boundaries = self.n_boundaries + 1
+        if not self.interval or self.n_boundaries % self.interval:
+            return
+        self.dot.finish_event()
+        state = dict(input_offset=self.reader.offset,
+                     output_offset=self.dot.flush(),
+                     n_events=n_events,
+                     skipped_events=skipped_events,
+                     candidate_events=candidate_events,
+                     interval=self.interval,
+                     options=self.options,
+                     source_size=self.source_size,
+                     source_mtime=self.source_mtime)
+        # only a complete checkpoint ever appears under the final name
+        tmp_checkpoint_file = self.checkpoint_file + '.tmp'
+        import json
+        with open(tmp_checkpoint_file, 'w') as checkpoint:
+            json.dump(state, checkpoint)
+        os.rename(tmp_checkpoint_file, self.checkpoint_file)
+
+    @staticmethod
+    def load(checkpoint_file, hepmc_file, options):
+        """
+        Returns the state recorded in the given checkpoint file, after checking that the input
+        file did not change since and that the conversion options are the same
+        """
+        import json
+        with open(checkpoint_file, 'r') as checkpoint:
+            state = json.load(checkpoint)
+        if (state['source_size'], state['source_mtime']) != _get_source_stamp(hepmc_file):
+            raise ValueError('%s changed since the checkpoint was written' % hepmc_file)
+        changed_options = sorted(name for name in options
+                                 if state['options'].get(name) != options[name])
+        if changed_options:
+            raise ValueError('resumed conversion changes the options %s of the checkpoint'
+                             % ', '.join(changed_options))
+        return state
+
+
+def _convert_cached(hepmc_file, cache_file, dot, max_events, skip_events, stride=1,
+                    sample=None, sample_seed=None):
+    """
+    Feeds the selected events of the binary cache of the given file to the writer and returns
+    the number of events. The selection is the same as for the text.
+    """
+    cache = _open_cache(hepmc_file, cache_file)
+    rendered_cache = None
+    try:
+        indices = range(skip_events, len(cache))
+        if sample is not None:
+            indices = _reservoir_sample(indices, sample, sample_seed)
+        else:
+            indices = indices[::stride]
+        if max_events >= 0:
+            indices = indices[:max_events]
+        if isinstance(dot, HepDotWriter):
+            # the complete events are copied as rendered by an earlier conversion, as formatting
+            # them takes much longer than parsing
+            rendered_cache = _open_rendered_cache(hepmc_file, cache, cache_file + '.rendered',
+                                                  dot.get_output_options())
+            for index in indices:
+                rendered_cache.write_event(index, dot)
+        else:
+            for index in indices:
+                cache.replay_event(index, dot)
+    finally:
+        if rendered_cache is not None:
+            rendered_cache.close()
+        cache.close()
+    return len(indices)
+
+
+def _sample_event_offsets(hepmc_file, n_sample, skip_events=0, seed=None):
+    """
+    Draws n_sample events uniformly at random from the given file by reservoir sampling and
+    returns the byte offsets of their 'E' records in file order.
+
+    Only the offsets of the kept events are stored, so the memory footprint depends on n_sample
+    and not on the size of the file.
     """
-    begin_event_pattern = re.compile(r'^E .*$')
-    vertex_pattern = re.compile(r'^V .*$')
-    particle_pattern = re.compile(r'^P .*$')
-    
-    with open(hepmc_file, 'r') as hepmc:
-        dot = HepDotWriter(dot_file)
-        n_events = 0
-        skipped_events = 0
-        skipping_event = False
+    offsets = itertools.islice(_iter_event_offsets(hepmc_file), skip_events, None)
+    return _reservoir_sample(offsets, n_sample, seed)
+
+
+def _reservoir_sample(items, n_sample, seed=None):
+    """
+    Draws n_sample of the given items uniformly at random in a single pass and returns them
+    sorted, i.e. in file order for event offsets or indices
+    """
+    import random
+    rng = random.Random(seed)
+    reservoir = []
+    n_seen = 0
+    for item in items:
+        if len(reservoir) < n_sample:
+            reservoir.append(item)
+            n_seen = n_seen + 1
+        else:
+            n_seen = n_seen + 1
+            slot = rng.randrange(n_seen)
+            if slot < n_sample:
+                reservoir[slot] = item
+    return sorted(reservoir)
+
+
+def _iter_event_offsets(hepmc_file):
+    """
+    Yields the byte offsets of all 'E' records of the given file
+    """
+    offset = 0
+    with open(hepmc_file, 'rb') as hepmc:
         for line in hepmc:
-            if begin_event_pattern.match(line):
-                if (skipped_events < skip_events):
-                    # need to skip this event
-                    skipped_events = skipped_events + 1
-                    skipping_event = True
+            if line.startswith(b'E '):
+                yield offset
+            offset = offset + len(line)
+
+
+def _iter_event_lines(hepmc_file, offsets):
+    """
+    Yields the lines of the events starting at the given byte offsets, one event after the other
+    """
+    with open(hepmc_file, 'rb') as hepmc:
+        for offset in offsets:
+            hepmc.seek(offset)
+            # the first line is the 'E' record of the event itself
+            yield hepmc.readline().decode()
+            for line in iter(hepmc.readline, b''):
+                if line.startswith(b'E '):
+                    break
+                yield line.decode()
+
+
+# binary event cache: header, then per event an event header followed by the vertex and particle
+# columns, then the table of event offsets, all stored little-endian
+_cache_header = struct.Struct('<4sIqdqq')
+_cache_event_header = struct.Struct('<qii')
+_cache_magic = b'H2DC'
+_cache_version = 2
+# (type code, record field) of the stored columns, the record fields are those of
+# _parse_vertex and _parse_particle
+_cache_vertex_columns = [('i', 0), ('d', 1), ('d', 2), ('d', 3), ('i', 4)]
+_cache_particle_columns = [('i', 0), ('i', 1), ('d', 2), ('d', 3), ('d', 4), ('d', 5), ('i', 6)]
+
+
+def _get_source_stamp(hepmc_file):
+    """
+    Returns the (size, mtime) of the given file, used to validate the caches built from it
+    """
+    stat = os.stat(hepmc_file)
+    return stat.st_size, stat.st_mtime
+
+
+def _pack_column(typecode, values):
+    return struct.pack('<%d%s' % (len(values), typecode), *values)
+
+
+def _read_column(buffer, typecode, length, offset):
+    column_format = '<%d%s' % (length, typecode)
+    column = struct.unpack_from(column_format, buffer, offset)
+    return column, offset + struct.calcsize(column_format)
+
+
+def _map_cache_file(cache_file):
+    """
+    Returns the memory mapping of the given file (or None) and its contents, which are the mapping
+    itself where possible
+    """
+    import mmap
+    with open(cache_file, 'rb') as cache:
+        try:
+            mapping = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+            return mapping, mapping
+        except (ValueError, EnvironmentError):
+            # e.g. empty files or file systems without mmap support
+            return None, cache.read()
+
+
+def build_cache(hepmc_file, cache_file):
+    """
+    Parses the given HepMC::IO_GenEvent formatted file once and stores its events as a binary
+    columnar cache, which later conversions load instead of parsing the text again
+    """
+    source_size, source_mtime = _get_source_stamp(hepmc_file)
+    tmp_cache_file = cache_file + '.tmp'
+    offsets = []
+    with open(tmp_cache_file, 'wb') as cache:
+        cache.write(_cache_header.pack(_cache_magic, _cache_version,
+                                       source_size, source_mtime, 0, 0))
+        evt_num = None
+        vertices = []
+        particles = []
+        # number of particles listed after each vertex
+        n_hosted = []
+        with open(hepmc_file, 'r') as hepmc:
+            for line in hepmc:
+                if line.startswith('E '):
+                    if evt_num is not None:
+                        offsets.append(cache.tell())
+                        _write_cached_event(cache, evt_num, vertices, n_hosted, particles)
+                    evt_num_column = 1
+                    evt_num = int(line.split()[evt_num_column])
+                    vertices = []
+                    particles = []
+                    n_hosted = []
+                elif evt_num is None:
                     continue
-                else:
-                    # done skipping events! Continue with normal processing
-                    skipping_event = False
-                if (max_events >= 0) and (n_events >= max_events):
-                    break; # Stop processing events
-                dot.start_new_event(line)
-                n_events = n_events + 1
-            elif vertex_pattern.match(line):
-                if not skipping_event:
-                    dot.start_new_vertex(line)
-            elif particle_pattern.match(line):
-                if not skipping_event:
-                    dot.add_outgoing_particle(line)
-            # ignore unknown lines
+                elif line.startswith('V '):
+                    vertices.append(_parse_vertex(line))
+                    n_hosted.append(0)
+                elif line.startswith('P ') and vertices:
+                    particles.append(_parse_particle(line))
+                    n_hosted[-1] = n_hosted[-1] + 1
+        if evt_num is not None:
+            offsets.append(cache.tell())
+            _write_cached_event(cache, evt_num, vertices, n_hosted, particles)
+
+        table_offset = cache.tell()
+        cache.write(_pack_column('q', offsets))
+        cache.seek(0)
+        cache.write(_cache_header.pack(_cache_magic, _cache_version,
+                                       source_size, source_mtime, len(offsets), table_offset))
+    # only a complete cache ever appears under the final name
+    os.rename(tmp_cache_file, cache_file)
+
+
+def _write_cached_event(cache, evt_num, vertices, n_hosted, particles):
+    cache.write(_cache_event_header.pack(evt_num, len(vertices), len(particles)))
+    cache.write(_pack_column('i', n_hosted))
+    for typecode, field in _cache_vertex_columns:
+        cache.write(_pack_column(typecode, [vertex[field] for vertex in vertices]))
+    for typecode, field in _cache_particle_columns:
+        cache.write(_pack_column(typecode, [particle[field] for particle in particles]))
+
+
+class HepEventCache(object):
+    """
+    Read access to a binary event cache written by build_cache. The file is memory-mapped where
+    possible, so only the events that are actually converted are read from disk.
+    """
+
+    def __init__(self, cache_file):
+        self.offsets = None
+        self.mapping, self.buffer = _map_cache_file(cache_file)
+        if len(self.buffer) < _cache_header.size:
+            self.close()
+            raise ValueError('%s is not an event cache' % cache_file)
+        (magic, version, self.source_size, self.source_mtime, n_events,
+         table_offset) = _cache_header.unpack_from(self.buffer, 0)
+        if (magic, version) != (_cache_magic, _cache_version):
+            self.close()
+            raise ValueError('%s is not a compatible event cache' % cache_file)
+        self.offsets, _ = _read_column(self.buffer, 'q', n_events, table_offset)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def is_valid_for(self, hepmc_file):
+        """
+        Returns whether the cache was built from the given file in its current state
+        """
+        return (self.source_size, self.source_mtime) == _get_source_stamp(hepmc_file)
+
+    def replay_event(self, index, writer):
+        """
+        Feeds the event with the given index to the writer, like convert() does for the text, and
+        returns its event number
+        """
+        offset = self.offsets[index]
+        evt_num, n_vertices, n_particles = _cache_event_header.unpack_from(self.buffer, offset)
+        offset = offset + _cache_event_header.size
+        n_hosted, offset = _read_column(self.buffer, 'i', n_vertices, offset)
+        vertex_columns = []
+        for typecode, _ in _cache_vertex_columns:
+            column, offset = _read_column(self.buffer, typecode, n_vertices, offset)
+            vertex_columns.append(column)
+        particle_columns = []
+        for typecode, _ in _cache_particle_columns:
+            column, offset = _read_column(self.buffer, typecode, n_particles, offset)
+            particle_columns.append(column)
+
+        writer.start_new_event('E %d\n' % evt_num)
+        particles = iter(zip(*particle_columns))
+        for vertex, n_vtx_particles in zip(zip(*vertex_columns), n_hosted):
+            writer.add_vertex(vertex)
+            for particle in itertools.islice(particles, n_vtx_particles):
+                writer.add_particle(particle)
+        return evt_num
+
+    def close(self):
+        """
+        Releases the memory mapping of the cache file.
+        """
+        self.offsets = None
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+
+def _open_cache(hepmc_file, cache_file):
+    """
+    Returns the event cache for the given file, (re)building it if it is missing or stale
+    """
+    if os.path.exists(cache_file):
+        try:
+            cache = HepEventCache(cache_file)
+        except ValueError:
+            cache = None
+        if cache is not None:
+            if cache.is_valid_for(hepmc_file):
+                return cache
+            cache.close()
+    build_cache(hepmc_file, cache_file)
+    return HepEventCache(cache_file)
+
+
+# rendered event cache: the DOT text of every event as written with one set of output options,
+# then the tables of event offsets, event numbers and node counts, then a trailer with the options
+_rendered_cache_trailer = struct.Struct('<qdqq?iqd4sI')
+_rendered_cache_magic = b'H2DR'
+_rendered_cache_version = 1
+
+
+def build_rendered_cache(cache, rendered_cache_file, output_options):
+    """
+    Renders all events of the given event cache with the given HepDotWriter output options and
+    stores the DOT text of each of them, which later conversions with the same options copy
+    """
+    tmp_rendered_cache_file = rendered_cache_file + '.tmp'
+    dot = HepDotWriter(tmp_rendered_cache_file, **output_options)
+    offsets = [0]
+    evt_nums = []
+    n_nodes = []
+    for index in range(len(cache)):
+        evt_nums.append(cache.replay_event(index, dot))
+        dot.finish_event()
+        n_nodes.append(dot.nodes_in_event)
+        offsets.append(dot.flush())
+    dot.close()
+
+    vtx_threshold = output_options['vtx_threshold']
+    with open(tmp_rendered_cache_file, 'ab') as rendered_cache:
+        rendered_cache.write(_pack_column('q', offsets))
+        rendered_cache.write(_pack_column('q', evt_nums))
+        rendered_cache.write(_pack_column('q', n_nodes))
+        rendered_cache.write(_rendered_cache_trailer.pack(
+            cache.source_size, cache.source_mtime, len(evt_nums), offsets[-1],
+            output_options['compact'], output_options['label_detail'],
+            -1 if vtx_threshold is None else vtx_threshold, output_options['scale'],
+            _rendered_cache_magic, _rendered_cache_version))
+    # only a complete cache ever appears under the final name
+    os.rename(tmp_rendered_cache_file, rendered_cache_file)
+
+
+class HepRenderedCache(object):
+    """
+    Read access to a rendered event cache written by build_rendered_cache, memory-mapped like
+    HepEventCache
+    """
+
+    def __init__(self, rendered_cache_file):
+        self.offsets = None
+        self.mapping, self.buffer = _map_cache_file(rendered_cache_file)
+        trailer_offset = len(self.buffer) - _rendered_cache_trailer.size
+        if trailer_offset < 0:
+            self.close()
+            raise ValueError('%s is not a rendered event cache' % rendered_cache_file)
+        (self.source_size, self.source_mtime, n_events, table_offset, compact, label_detail,
+         vtx_threshold, scale, magic, version) = _rendered_cache_trailer.unpack_from(
+             self.buffer, trailer_offset)
+        if (magic, version) != (_rendered_cache_magic, _rendered_cache_version):
+            self.close()
+            raise ValueError('%s is not a compatible rendered event cache' % rendered_cache_file)
+        self.output_options = dict(compact=compact, label_detail=label_detail,
+                                   vtx_threshold=None if vtx_threshold < 0 else vtx_threshold,
+                                   scale=scale)
+        self.offsets, offset = _read_column(self.buffer, 'q', n_events + 1, table_offset)
+        self.evt_nums, offset = _read_column(self.buffer, 'q', n_events, offset)
+        self.n_nodes, _ = _read_column(self.buffer, 'q', n_events, offset)
+
+    def __len__(self):
+        return len(self.evt_nums)
+
+    def is_valid_for(self, hepmc_file, output_options):
+        """
+        Returns whether the cache was rendered with the given output options from the given file
+        in its current state
+        """
+        return ((self.source_size, self.source_mtime) == _get_source_stamp(hepmc_file) and
+                self.output_options == output_options)
+
+    def write_event(self, index, writer):
+        """
+        Writes the event with the given index to the HepDotWriter
+        """
+        dot = self.buffer[self.offsets[index]:self.offsets[index + 1]]
+        if not isinstance(dot, str):
+            # Python 3
+            dot = dot.decode()
+        writer.add_rendered_event(self.evt_nums[index], dot, self.n_nodes[index])
+
+    def close(self):
+        """
+        Releases the memory mapping of the cache file.
+        """
+        self.offsets = None
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+
+def _open_rendered_cache(hepmc_file, cache, rendered_cache_file, output_options):
+    """
+    Returns the rendered event cache for the given file and output options, (re)building it from
+    the given event cache if it is missing, stale or rendered with other options
+    """
+    if os.path.exists(rendered_cache_file):
+        try:
+            rendered_cache = HepRenderedCache(rendered_cache_file)
+        except ValueError:
+            rendered_cache = None
+        if rendered_cache is not None:
+            if rendered_cache.is_valid_for(hepmc_file, output_options):
+                return rendered_cache
+            rendered_cache.close()
+    build_rendered_cache(cache, rendered_cache_file, output_options)
+    return HepRenderedCache(rendered_cache_file)
 
-        print("Converted %d events." % n_events)
 
 if __name__ == '__main__':
     args = sys.argv[1:]
@@ -5,8 +5,28 @@ import tempfile
 
 import os
 import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
 from math import sqrt
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    # Python 3
+    from io import StringIO
+
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
+
+# captured before any test changes the working directory, as __file__ may be relative
+hepmc2dot_dir = os.path.dirname(os.path.abspath(hepmc2dot.__file__))
+
 
 # use global definition of expected particle and vertex DOT strings for test maintainability
 vtx_200334 = '    V_200334 [label="vtx #-200334\\nr=1027.68,z=1423.66",pos="1423.657,1027.677!"];\n'
@@ -394,3 +414,770 @@ class Test_main_withTemporaryFilesFixture(unittest.TestCase):
                                 + p_200394 \
                                 + '}\n'
         self.assertEqual(expected_dot_contents, actual_dot_contents)
+
+
+# small decay chain: V-1 -> (p1 -> V-2, p2), V-2 -> (p3 -> V-3, p4), V-3 -> p5
+decay_chain_event = [
+    "E 7 -1 -1.00000000e+00 -1.00000000e+00 -1.00000000e+00 1111230000 -1 0 1 2 0 3\n",
+    "V -1 0 0.00000000e+00 0.00000000e+00 0.00000000e+00 0.00000000e+00 0 2 0\n",
+    "P 1 511 1.00000000e+01 0.00000000e+00 1.00000000e+01 2.00000000e+01 5.27900000e+00 2 0 0 -2 0\n",
+    "P 2 211 -1.00000000e+01 0.00000000e+00 1.00000000e+01 2.00000000e+01 1.39570099e-01 1 0 0 0 0\n",
+    "V -2 0 1.00000000e+00 0.00000000e+00 1.00000000e+00 0.00000000e+00 0 2 0\n",
+    "P 3 421 5.00000000e+00 1.00000000e+00 5.00000000e+00 1.00000000e+01 1.86500000e+00 2 0 0 -3 0\n",
+    "P 4 22 5.00000000e+00 -1.00000000e+00 5.00000000e+00 1.00000000e+01 0.00000000e+00 1 0 0 0 0\n",
+    "V -3 0 2.00000000e+00 1.00000000e+00 2.00000000e+00 0.00000000e+00 0 1 0\n",
+    "P 5 321 5.00000000e+00 1.00000000e+00 5.00000000e+00 1.00000000e+01 4.93700000e-01 1 0 0 0 0\n",
+]
+
+
+def _build_decay_chain_index():
+    index = hepmc2dot.HepEventIndex()
+    for line in decay_chain_event[1:]:
+        if line.startswith('V'):
+            index.add_vertex(hepmc2dot._parse_vertex(line))
+        else:
+            index.add_particle(hepmc2dot._parse_particle(line))
+    return index
+
+
+class Test_HepEventIndex(unittest.TestCase):
+
+    def test_particleSeed_expectDecayChainBelowParticle(self):
+        vertices, particles = _build_decay_chain_index().descendants([3])
+        self.assertEqual(set([-3]), vertices)
+        self.assertEqual(set([3, 5]), particles)
+
+    def test_vertexSeedWithDepth_expectOnlyFirstGeneration(self):
+        vertices, particles = _build_decay_chain_index().descendants([-1], max_depth=1)
+        self.assertEqual(set([-1, -2]), vertices)
+        self.assertEqual(set([1, 2]), particles)
+
+    def test_vertexSeedAncestors_expectHistoryUpToFirstVertex(self):
+        vertices, particles = _build_decay_chain_index().ancestors([-3])
+        self.assertEqual(set([-1, -2, -3]), vertices)
+        self.assertEqual(set([1, 3]), particles)
+
+    def test_unknownSeed_expectEmptySelection(self):
+        vertices, particles = _build_decay_chain_index().descendants([42, -42])
+        self.assertEqual(set(), vertices)
+        self.assertEqual(set(), particles)
+
+
+class Test_convert_withSeeds(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+        self.hepmc_file = os.path.join(self.rundir, 'hepmc.txt')
+        with open(self.hepmc_file, 'w') as f:
+            f.writelines(decay_chain_event)
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def convert_to_string(self, **kwargs):
+        dot_file = os.path.join(self.rundir, 'graph.dot')
+        hepmc2dot.convert(self.hepmc_file, dot_file, -1, 0, **kwargs)
+        with open(dot_file, 'r') as f:
+            return f.read()
+
+    def test_particleSeed_expectOnlyDecayChainInDot(self):
+        actual_dot_contents = self.convert_to_string(seeds=[3])
+        self.assertTrue(actual_dot_contents.startswith('digraph event_7 {\n'))
+        self.assertIn('V_2 -> V_3 ', actual_dot_contents)
+        self.assertIn('V_3 -> V_dummy_5 ', actual_dot_contents)
+        self.assertNotIn('V_1 ', actual_dot_contents)
+        self.assertNotIn('V_dummy_4 ', actual_dot_contents)
+
+    def test_noSeeds_expectFullEvent(self):
+        actual_dot_contents = self.convert_to_string()
+        for edge in ['V_1 -> V_2 ', 'V_1 -> V_dummy_2 ', 'V_2 -> V_3 ', 'V_2 -> V_dummy_4 ',
+                     'V_3 -> V_dummy_5 ']:
+            self.assertIn(edge, actual_dot_contents)
+
+
+class Test_convert_withSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+        self.hepmc_file = os.path.join(self.rundir, 'hepmc.txt')
+        with open(self.hepmc_file, 'w') as f:
+            for evt_num in range(10):
+                f.write("E %d -1 -1.00000000e+00 -1.00000000e+00 -1.00000000e+00 1111230000 -243 534 1 2 0 3\n"
+                        % evt_num)
+                f.write("V -200648 1121 9.51900940e+02 -5.33236511e+02 -1.88166296e+03 2.88058228e+03 0 1 1 2.00877000e+05\n")
+                f.write("P 200386 2112 -2.51403702e+02 4.56170502e+02 -1.67972778e+02 1.08733311e+03 9.39565369e+02 1 0 0 0 0\n")
+        self.dot_file = os.path.join(self.rundir, 'graph.dot')
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def converted_events(self, *args, **kwargs):
+        hepmc2dot.convert(self.hepmc_file, self.dot_file, *args, **kwargs)
+        with open(self.dot_file, 'r') as f:
+            return [line.split()[1] for line in f if line.startswith('digraph')]
+
+    def test_stride_expectEveryNthEventAfterSkip(self):
+        self.assertEqual(['event_1', 'event_4', 'event_7'], self.converted_events(-1, 1, stride=3))
+
+    def test_strideAndMaxEvents_expectLimitedNumberOfEvents(self):
+        self.assertEqual(['event_0', 'event_2'], self.converted_events(2, 0, stride=2))
+
+    def test_sample_expectRequestedNumberOfDistinctEventsInFileOrder(self):
+        events = self.converted_events(-1, 0, sample=4, sample_seed=1)
+        self.assertEqual(4, len(set(events)))
+        self.assertEqual(sorted(events, key=lambda evt: int(evt.split('_')[1])), events)
+        self.assertEqual(events, self.converted_events(-1, 0, sample=4, sample_seed=1))
+
+    def test_sampleLargerThanFile_expectAllEventsAfterSkip(self):
+        expected_events = ['event_%d' % evt_num for evt_num in range(2, 10)]
+        self.assertEqual(expected_events, self.converted_events(-1, 2, sample=20))
+
+    def test_sampledEvent_expectSameContentsAsFullConversion(self):
+        hepmc2dot.convert(self.hepmc_file, self.dot_file, 1, 5)
+        with open(self.dot_file, 'r') as f:
+            expected_dot_contents = f.read()
+        # a sample of all but the first five events, capped to one event, is event 5
+        hepmc2dot.convert(self.hepmc_file, self.dot_file, 1, 5, sample=5)
+        with open(self.dot_file, 'r') as f:
+            actual_dot_contents = f.read()
+        self.assertEqual(expected_dot_contents, actual_dot_contents)
+
+    def test_strideAndSample_expectValueError(self):
+        self.assertRaises(ValueError, hepmc2dot.convert, self.hepmc_file, self.dot_file, -1, 0,
+                          stride=2, sample=2)
+
+
+class Test_get_chunk_name(unittest.TestCase):
+
+    def test_plainDotFile_expectNumberBeforeExtension(self):
+        self.assertEqual('graph.002.dot', hepmc2dot._get_chunk_name('graph.dot', 2))
+
+    def test_compressedDotFile_expectNumberBeforeExtensions(self):
+        self.assertEqual('out/graph.000.dot.gz', hepmc2dot._get_chunk_name('out/graph.dot.gz', 0))
+        self.assertEqual('graph.010.dot.xz', hepmc2dot._get_chunk_name('graph.dot.xz', 10))
+
+
+class Test_HepDotWriter_output(unittest.TestCase):
+
+    event_lines = [
+        "V -200648 1121 9.51900940e+02 -5.33236511e+02 -1.88166296e+03 2.88058228e+03 0 1 1 2.00877000e+05\n",
+        "P 200386 2112 -2.51403702e+02 4.56170502e+02 -1.67972778e+02 1.08733311e+03 9.39565369e+02 1 0 0 0 0\n",
+    ]
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def write_events(self, dot_file, n_events, **kwargs):
+        dot = hepmc2dot.HepDotWriter(os.path.join(self.rundir, dot_file), **kwargs)
+        for evt_num in range(n_events):
+            dot.start_new_event("E %d -1\n" % evt_num)
+            dot.start_new_vertex(self.event_lines[0])
+            dot.add_outgoing_particle(self.event_lines[1])
+        dot.close()
+
+    def read(self, dot_file, opener=open):
+        with opener(os.path.join(self.rundir, dot_file), 'rt') as f:
+            return f.read()
+
+    def test_gzipOutput_expectSameContentsAsPlainOutput(self):
+        import gzip
+        self.write_events('graph.dot', 3)
+        self.write_events('graph.dot.gz', 3)
+        self.assertEqual(self.read('graph.dot'), self.read('graph.dot.gz', gzip.open))
+
+    @unittest.skipIf(lzma is None, 'needs the lzma module')
+    def test_xzOutput_expectSameContentsAsPlainOutput(self):
+        self.write_events('graph.dot', 3)
+        self.write_events('graph.dot.xz', 3)
+        self.assertEqual(self.read('graph.dot'), self.read('graph.dot.xz', lzma.open))
+
+    def test_xzOutputWithoutLzma_expectValueError(self):
+        # a None entry makes the import fail, like on Python 2
+        lzma_module = sys.modules.get('lzma')
+        sys.modules['lzma'] = None
+        try:
+            self.assertRaises(ValueError, self.write_events, 'graph.dot.xz', 1)
+        finally:
+            if lzma_module is None:
+                del sys.modules['lzma']
+            else:
+                sys.modules['lzma'] = lzma_module
+
+    def test_eventsPerFile_expectChunksOnDigraphBoundaries(self):
+        self.write_events('graph.dot', 5, events_per_file=2)
+        self.assertEqual(['graph.000.dot', 'graph.001.dot', 'graph.002.dot'],
+                         sorted(os.listdir(self.rundir)))
+        self.write_events('full.dot', 5)
+        chunks = [self.read('graph.%03d.dot' % chunk) for chunk in range(3)]
+        for chunk in chunks:
+            self.assertTrue(chunk.startswith('digraph '))
+            self.assertTrue(chunk.endswith('}\n'))
+        self.assertEqual(self.read('full.dot'), ''.join(chunks))
+
+    def test_bytesPerFile_expectOneEventPerChunkWhenLimitIsSmall(self):
+        self.write_events('graph.dot', 3, bytes_per_file=1)
+        self.assertEqual(['graph.000.dot', 'graph.001.dot', 'graph.002.dot'],
+                         sorted(os.listdir(self.rundir)))
+        self.assertEqual(1, self.read('graph.001.dot').count('digraph '))
+
+
+class Test_HepDotWriter_compact(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+        self.dot_file = os.path.join(self.rundir, 'graph.dot')
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def write_decay_chain(self, **kwargs):
+        dot = hepmc2dot.HepDotWriter(self.dot_file, **kwargs)
+        dot.start_new_event(decay_chain_event[0])
+        for line in decay_chain_event[1:]:
+            if line.startswith('V'):
+                dot.start_new_vertex(line)
+            else:
+                dot.add_outgoing_particle(line)
+        dot.close()
+        with open(self.dot_file, 'r') as f:
+            return f.read()
+
+    def test_compact_expectNodeDefaultsAndShortNodeNames(self):
+        actual_dot_contents = self.write_decay_chain(compact=True)
+        self.assertTrue(actual_dot_contents.startswith('digraph event_7 {\n'
+                                                       'node[shape=point,label=""]\n'
+                                                       'n0[pos="0.000,0.000!"]\n'
+                                                       'n0->n1[color=red,label="p #1, id=511\\n'))
+        self.assertNotIn('V_', actual_dot_contents)
+        self.assertEqual(1, actual_dot_contents.count('label=""'))
+
+    def test_compact_expectSameGraphAsDefaultProfile(self):
+        default_dot_contents = self.write_decay_chain()
+        compact_dot_contents = self.write_decay_chain(compact=True)
+        self.assertEqual(default_dot_contents.count(' -> '), compact_dot_contents.count('->'))
+        self.assertEqual(default_dot_contents.count('pos='), compact_dot_contents.count('pos='))
+        self.assertEqual(default_dot_contents.count('shape=none'),
+                         compact_dot_contents.count('shape=none'))
+        self.assertLess(len(compact_dot_contents), len(default_dot_contents))
+
+    def test_labelDetailId_expectOnlyParticleIdInLabels(self):
+        actual_dot_contents = self.write_decay_chain(compact=True, label_detail=hepmc2dot.LABEL_ID)
+        self.assertIn('n0->n1[color=red,label="511"]\n', actual_dot_contents)
+        self.assertNotIn('p #', actual_dot_contents)
+
+    def test_labelDetailNone_expectNoParticleLabels(self):
+        actual_dot_contents = self.write_decay_chain(compact=True,
+                                                     label_detail=hepmc2dot.LABEL_NONE)
+        self.assertIn('n0->n1[color=red]\n', actual_dot_contents)
+        self.assertEqual(1, actual_dot_contents.count('label='))
+
+
+class Test_get_compact_dot_vertex(unittest.TestCase):
+
+    def test_vertex_expectOnlyPosition(self):
+        actual_dot = hepmc2dot._get_compact_dot_vertex('n3', 2, 3, scale=4)
+        self.assertEqual('n3[pos="12.000,8.000!"]\n', actual_dot)
+
+    def test_dummyVertex_expectShapeOverride(self):
+        actual_dot = hepmc2dot._get_compact_dot_vertex('n3', 2, 3, is_dummy=True)
+        self.assertEqual('n3[shape=none,pos="3.000,2.000!"]\n', actual_dot)
+
+
+class Test_HepDotWriter_perEvent(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def write_events(self, n_events, template='event_{event}.dot', **kwargs):
+        dot = hepmc2dot.HepDotWriter(os.path.join(self.rundir, template), per_event=True, **kwargs)
+        for evt_num in range(n_events):
+            dot.start_new_event("E %d -1\n" % (evt_num + 10))
+            dot.start_new_vertex(Test_HepDotWriter_output.event_lines[0])
+            dot.add_outgoing_particle(Test_HepDotWriter_output.event_lines[1])
+        dot.close()
+
+    def read_manifest(self, manifest_file='manifest.tsv'):
+        with open(os.path.join(self.rundir, manifest_file), 'r') as f:
+            return [line.rstrip('\n').split('\t') for line in f]
+
+    def test_threeEvents_expectOneDigraphPerFile(self):
+        self.write_events(3)
+        self.assertEqual(['event_10.dot', 'event_11.dot', 'event_12.dot', 'manifest.tsv'],
+                         sorted(os.listdir(self.rundir)))
+        with open(os.path.join(self.rundir, 'event_11.dot'), 'r') as f:
+            actual_dot_contents = f.read()
+        self.assertTrue(actual_dot_contents.startswith('digraph event_11 {\n'))
+        self.assertEqual(1, actual_dot_contents.count('digraph '))
+
+    def test_threeEvents_expectManifestWithNodeCountAndSize(self):
+        self.write_events(3)
+        manifest = self.read_manifest()
+        self.assertEqual(['event', 'file', 'nodes', 'bytes'], manifest[0])
+        self.assertEqual(4, len(manifest))
+        for evt_num, row in zip(range(10, 13), manifest[1:]):
+            event_file = os.path.join(self.rundir, 'event_%d.dot' % evt_num)
+            self.assertEqual([str(evt_num), event_file, '2', str(os.path.getsize(event_file))],
+                             row)
+
+    def test_indexTemplateAndManifestFile_expectNumberedFilesAndGivenManifest(self):
+        manifest_file = os.path.join(self.rundir, 'index.tsv')
+        self.write_events(2, template='{index:04d}.dot', manifest_file=manifest_file)
+        self.assertEqual(['0000.dot', '0001.dot', 'index.tsv'], sorted(os.listdir(self.rundir)))
+        self.assertEqual(3, len(self.read_manifest('index.tsv')))
+
+    def test_zeroPaddedEventTemplate_expectPaddedFileNames(self):
+        self.write_events(2, template='event_{event:05d}.dot')
+        self.assertEqual(['event_00010.dot', 'event_00011.dot', 'manifest.tsv'],
+                         sorted(os.listdir(self.rundir)))
+        self.assertEqual(['10', '11'], [row[0] for row in self.read_manifest()[1:]])
+
+    def test_templateWithoutFields_expectValueError(self):
+        self.assertRaises(ValueError, hepmc2dot.HepDotWriter,
+                          os.path.join(self.rundir, 'same.dot'), per_event=True)
+        self.assertEqual([], os.listdir(self.rundir))
+
+    def test_templateWithOtherFields_expectValueError(self):
+        for template in ['event_{}.dot', 'event_{name}.dot', 'event_{event[0]}.dot',
+                         'event_{event:q}.dot']:
+            self.assertRaises(ValueError, hepmc2dot.HepDotWriter,
+                              os.path.join(self.rundir, template), per_event=True)
+        self.assertEqual([], os.listdir(self.rundir))
+
+    def test_templatedDirectory_expectValueErrorWithoutManifestFile(self):
+        self.assertRaises(ValueError, hepmc2dot.HepDotWriter,
+                          os.path.join(self.rundir, 'event_{event}', 'graph.dot'), per_event=True)
+
+    def test_templatedDirectoryAndManifestFile_expectOneDirectoryPerEvent(self):
+        self.write_events(2, template=os.path.join('event_{event}', 'graph.dot'),
+                          manifest_file=os.path.join(self.rundir, 'manifest.tsv'))
+        self.assertEqual(['event_10', 'event_11', 'manifest.tsv'], sorted(os.listdir(self.rundir)))
+        self.assertEqual(['graph.dot'], os.listdir(os.path.join(self.rundir, 'event_11')))
+
+    def test_perEventAndRotation_expectValueError(self):
+        self.assertRaises(ValueError, hepmc2dot.HepDotWriter,
+                          os.path.join(self.rundir, 'event_{event}.dot'), events_per_file=2,
+                          per_event=True)
+
+
+class Test_convert_withCache(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+        self.hepmc_file = os.path.join(self.rundir, 'hepmc.txt')
+        with open(self.hepmc_file, 'w') as f:
+            for evt_num in range(3):
+                f.write(decay_chain_event[0].replace('E 7 ', 'E %d ' % evt_num))
+                f.writelines(decay_chain_event[1:])
+        self.cache_file = os.path.join(self.rundir, 'hepmc.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def convert_to_string(self, *args, **kwargs):
+        dot_file = os.path.join(self.rundir, 'graph.dot')
+        hepmc2dot.convert(self.hepmc_file, dot_file, *args, **kwargs)
+        with open(dot_file, 'r') as f:
+            return f.read()
+
+    def test_cache_expectSameDotAsText(self):
+        expected_dot_contents = self.convert_to_string(-1, 0)
+        # first conversion builds the cache, second one reads it
+        self.assertEqual(expected_dot_contents,
+                         self.convert_to_string(-1, 0, cache_file=self.cache_file))
+        self.assertTrue(os.path.exists(self.cache_file))
+        self.assertTrue(os.path.exists(self.cache_file + '.rendered'))
+        self.assertEqual(expected_dot_contents,
+                         self.convert_to_string(-1, 0, cache_file=self.cache_file))
+
+    def test_cacheWithSelection_expectSameDotAsText(self):
+        for args, kwargs in [((1, 1), {}), ((-1, 0), dict(stride=2)),
+                             ((-1, 1), dict(sample=1, sample_seed=5)),
+                             ((-1, 0), dict(seeds=[-2], ancestors=True))]:
+            expected_dot_contents = self.convert_to_string(*args, **kwargs)
+            kwargs['cache_file'] = self.cache_file
+            self.assertEqual(expected_dot_contents, self.convert_to_string(*args, **kwargs))
+
+    def test_cacheWithOutputOptions_expectSameDotAsText(self):
+        # alternating options also rebuild the rendered events each time
+        for kwargs in [dict(compact=True), dict(label_detail=hepmc2dot.LABEL_NONE),
+                       dict(vtx_threshold=2, scale=50.), dict(compact=True), {}]:
+            expected_dot_contents = self.convert_to_string(-1, 0, **kwargs)
+            kwargs['cache_file'] = self.cache_file
+            for _ in range(2):
+                self.assertEqual(expected_dot_contents, self.convert_to_string(-1, 0, **kwargs))
+
+    def test_cacheWithPerEventOutput_expectSameFilesAndManifest(self):
+        contents = []
+        for cache_file in [None, self.cache_file, self.cache_file]:
+            shutil.rmtree(os.path.join(self.rundir, 'events'), ignore_errors=True)
+            os.mkdir(os.path.join(self.rundir, 'events'))
+            hepmc2dot.convert(self.hepmc_file, os.path.join(self.rundir, 'events', '{event}.dot'),
+                              -1, 0, per_event=True, cache_file=cache_file)
+            event_contents = {}
+            for name in os.listdir(os.path.join(self.rundir, 'events')):
+                with open(os.path.join(self.rundir, 'events', name), 'r') as f:
+                    event_contents[name] = f.read()
+            contents.append(event_contents)
+        self.assertEqual(4, len(contents[0]))
+        self.assertEqual(contents[0], contents[1])
+        self.assertEqual(contents[0], contents[2])
+
+    def test_modifiedInput_expectCacheRebuilt(self):
+        self.convert_to_string(-1, 0, cache_file=self.cache_file)
+        with open(self.hepmc_file, 'a') as f:
+            f.write(decay_chain_event[0].replace('E 7 ', 'E 3 '))
+        self.assertIn('digraph event_3 {',
+                      self.convert_to_string(-1, 0, cache_file=self.cache_file))
+
+    def test_invalidCacheFile_expectCacheRebuilt(self):
+        with open(self.cache_file, 'w') as f:
+            f.write('not a cache')
+        expected_dot_contents = self.convert_to_string(-1, 0)
+        self.assertEqual(expected_dot_contents,
+                         self.convert_to_string(-1, 0, cache_file=self.cache_file))
+
+    def test_emptyHepMCFile_expectEmptyCache(self):
+        open(self.hepmc_file, 'w').close()
+        hepmc2dot.build_cache(self.hepmc_file, self.cache_file)
+        cache = hepmc2dot.HepEventCache(self.cache_file)
+        self.assertEqual(0, len(cache))
+        self.assertTrue(cache.is_valid_for(self.hepmc_file))
+        cache.close()
+
+
+class Test_convert_withExtraWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+        self.hepmc_file = os.path.join(self.rundir, 'hepmc.txt')
+        with open(self.hepmc_file, 'w') as f:
+            f.writelines(decay_chain_event)
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def path(self, name):
+        return os.path.join(self.rundir, name)
+
+    def read(self, name):
+        with open(self.path(name), 'r') as f:
+            return f.read()
+
+    def test_statsWriter_expectOneRowPerEvent(self):
+        hepmc2dot.convert(self.hepmc_file, self.path('graph.dot'), -1, 0,
+                          extra_writers=[hepmc2dot.HepStatsWriter(self.path('stats.tsv'))])
+        self.assertEqual('event\tvertices\tparticles\tfinal_state\tfinal_state_energy\n'
+                         '7\t3\t5\t3\t40.000\n', self.read('stats.tsv'))
+
+    def test_extraDotWriters_expectSameOutputsAsSeparateConversions(self):
+        hepmc2dot.convert(self.hepmc_file, self.path('full.dot'), -1, 0)
+        hepmc2dot.convert(self.hepmc_file, self.path('chain.dot'), -1, 0, seeds=[3])
+        hepmc2dot.convert(self.hepmc_file, self.path('compact.dot'), -1, 0, compact=True)
+
+        extra_writers = [hepmc2dot.HepSubgraphWriter(self.path('chain_multi.dot'), [3]),
+                         hepmc2dot.HepDotWriter(self.path('compact_multi.dot'), compact=True)]
+        hepmc2dot.convert(self.hepmc_file, self.path('full_multi.dot'), -1, 0,
+                          extra_writers=extra_writers)
+        for name in ['full', 'chain', 'compact']:
+            self.assertEqual(self.read(name + '.dot'), self.read(name + '_multi.dot'))
+
+    def test_primaryAndStatsFiles_expectSameOutputsAsExtraWriters(self):
+        primary_writer = hepmc2dot.HepDotWriter(self.path('primary.dot'),
+                                                vtx_threshold=hepmc2dot.PRIMARY_VTX_THRESHOLD,
+                                                scale=50.)
+        stats_writer = hepmc2dot.HepStatsWriter(self.path('stats.tsv'))
+        hepmc2dot.convert(self.hepmc_file, self.path('graph.dot'), -1, 0,
+                          extra_writers=[primary_writer, stats_writer])
+        hepmc2dot.convert(self.hepmc_file, self.path('graph.dot'), -1, 0,
+                          primary_file=self.path('primary_file.dot'),
+                          stats_file=self.path('stats_file.tsv'))
+        self.assertEqual(self.read('primary.dot'), self.read('primary_file.dot'))
+        self.assertEqual(self.read('stats.tsv'), self.read('stats_file.tsv'))
+
+    def test_invalidOptions_expectStatsFileUntouchedAndExtraWritersClosed(self):
+        with open(self.path('stats.tsv'), 'w') as f:
+            f.write('previous results\n')
+        stats_writer = hepmc2dot.HepStatsWriter(self.path('extra_stats.tsv'))
+        self.assertRaises(ValueError, hepmc2dot.convert, self.hepmc_file, self.path('graph.dot'),
+                          -1, 0, stats_file=self.path('stats.tsv'), checkpoint_interval=2,
+                          extra_writers=[stats_writer])
+        self.assertEqual('previous results\n', self.read('stats.tsv'))
+        self.assertTrue(stats_writer.statsfile.closed)
+
+    def test_vtxThreshold_expectVerticesAboveThresholdAndTheirParticlesSkipped(self):
+        hepmc2dot.convert(self.hepmc_file, self.path('graph.dot'), -1, 0, vtx_threshold=2)
+        actual_dot_contents = self.read('graph.dot')
+        self.assertIn('V_1 -> V_2 ', actual_dot_contents)
+        self.assertIn('V_2 -> V_dummy_4 ', actual_dot_contents)
+        # p3 ends and p5 starts in V_3, which is above the threshold
+        self.assertNotIn('V_3', actual_dot_contents)
+        self.assertNotIn('V_dummy_5', actual_dot_contents)
+
+
+class Test_convert_withCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+        self.hepmc_file = os.path.join(self.rundir, 'hepmc.txt')
+        with open(self.hepmc_file, 'w') as f:
+            for evt_num in range(7):
+                f.write(decay_chain_event[0].replace('E 7 ', 'E %d ' % evt_num))
+                f.writelines(decay_chain_event[1:])
+        self.dot_file = os.path.join(self.rundir, 'graph.dot')
+        self.checkpoint_file = self.dot_file + '.checkpoint'
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def read_dot(self):
+        with open(self.dot_file, 'r') as f:
+            return f.read()
+
+    def convert_interrupted(self, n_vertices, *args, **kwargs):
+        """
+        Runs a conversion that is interrupted when writing the given number of vertices
+        """
+        add_vertex = hepmc2dot.HepDotWriter.add_vertex
+        calls = []
+
+        def interrupting_add_vertex(writer, vertex):
+            calls.append(vertex)
+            if len(calls) == n_vertices:
+                raise KeyboardInterrupt()
+            add_vertex(writer, vertex)
+
+        hepmc2dot.HepDotWriter.add_vertex = interrupting_add_vertex
+        try:
+            self.assertRaises(KeyboardInterrupt, hepmc2dot.convert, self.hepmc_file,
+                              self.dot_file, *args, **kwargs)
+        finally:
+            hepmc2dot.HepDotWriter.add_vertex = add_vertex
+
+    def test_completeConversion_expectSameDotAndNoCheckpointLeft(self):
+        hepmc2dot.convert(self.hepmc_file, self.dot_file, -1, 0)
+        expected_dot_contents = self.read_dot()
+        hepmc2dot.convert(self.hepmc_file, self.dot_file, -1, 0, checkpoint_interval=2)
+        self.assertEqual(expected_dot_contents, self.read_dot())
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+    def test_interruptedConversion_expectResumeCompletesSameDot(self):
+        hepmc2dot.convert(self.hepmc_file, self.dot_file, -1, 0)
+        expected_dot_contents = self.read_dot()
+
+        # interrupted in the middle of the 5th event, last checkpoint before the 5th event
+        self.convert_interrupted(3 * 4 + 2, -1, 0, checkpoint_interval=2)
+        self.assertTrue(os.path.exists(self.checkpoint_file))
+        self.assertNotEqual(expected_dot_contents, self.read_dot())
+
+        hepmc2dot.convert(self.hepmc_file, self.dot_file, -1, 0, resume=True)
+        self.assertEqual(expected_dot_contents, self.read_dot())
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+    def test_interruptedConversionWithSelection_expectResumeCompletesSameDot(self):
+        hepmc2dot.convert(self.hepmc_file, self.dot_file, 3, 1, stride=2, seeds=[3])
+        expected_dot_contents = self.read_dot()
+
+        self.convert_interrupted(3, 3, 1, stride=2, seeds=[3], checkpoint_interval=3)
+        hepmc2dot.convert(self.hepmc_file, self.dot_file, 3, 1, stride=2, seeds=[3], resume=True)
+        self.assertEqual(expected_dot_contents, self.read_dot())
+
+    def test_modifiedInput_expectValueErrorOnResume(self):
+        self.convert_interrupted(5, -1, 0, checkpoint_interval=1)
+        with open(self.hepmc_file, 'a') as f:
+            f.write(decay_chain_event[0])
+        self.assertRaises(ValueError, hepmc2dot.convert, self.hepmc_file, self.dot_file, -1, 0,
+                          resume=True)
+
+    def test_changedOptions_expectValueErrorOnResume(self):
+        self.convert_interrupted(5, -1, 0, checkpoint_interval=1)
+        self.assertRaises(ValueError, hepmc2dot.convert, self.hepmc_file, self.dot_file, -1, 0,
+                          stride=2, resume=True)
+        self.assertRaises(ValueError, hepmc2dot.convert, self.hepmc_file, self.dot_file, -1, 0,
+                          compact=True, resume=True)
+
+    def test_truncatedOutput_expectValueErrorOnResume(self):
+        self.convert_interrupted(5, -1, 0, checkpoint_interval=1)
+        with open(self.dot_file, 'w'):
+            pass
+        self.assertRaises(ValueError, hepmc2dot.convert, self.hepmc_file, self.dot_file, -1, 0,
+                          resume=True)
+        os.remove(self.dot_file)
+        self.assertRaises(ValueError, hepmc2dot.convert, self.hepmc_file, self.dot_file, -1, 0,
+                          resume=True)
+
+    def test_compressedOutput_expectValueError(self):
+        self.assertRaises(ValueError, hepmc2dot.convert, self.hepmc_file, self.dot_file + '.gz',
+                          -1, 0, checkpoint_interval=2)
+
+
+# time budget for a short command line invocation, relative to the start-up of a bare interpreter,
+# with plenty of headroom for shared machines (typically about 2.5)
+startup_time_budget = 5.
+
+
+class Test_startup(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+        self.hepmc_file = os.path.join(self.rundir, 'hepmc.txt')
+        with open(self.hepmc_file, 'w') as f:
+            f.writelines(decay_chain_event)
+        self.dot_file = os.path.join(self.rundir, 'graph.dot')
+        # a copy of the module, so that its bytecode can be cached like for an installed module
+        # without writing into the source tree
+        shutil.copy(os.path.join(hepmc2dot_dir, 'hepmc2dot.py'), self.rundir)
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def run_python(self, code):
+        # run next to the copy of the module, so that it is importable from the current directory
+        env = dict(os.environ)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        return subprocess.check_output([sys.executable, '-c', code], cwd=self.rundir,
+                                       env=env).decode()
+
+    def time_python(self, *codes):
+        """
+        Returns the shortest wall times of running each of the given codes in a new interpreter,
+        taking turns so that they all see the same load of the machine
+        """
+        times = [[] for _ in codes]
+        for _ in range(10):
+            for code, code_times in zip(codes, times):
+                start = time.time()
+                self.run_python(code)
+                code_times.append(time.time() - start)
+        return [min(code_times) for code_times in times]
+
+    def test_import_expectNoOptionalModulesLoaded(self):
+        loaded_modules = self.run_python('import sys\n'
+                                         'before = set(sys.modules)\n'
+                                         'import hepmc2dot\n'
+                                         'print(" ".join(set(sys.modules) - before))').split()
+        for module in ['argparse', 'json', 'mmap', 'random', 're', 'gzip', 'lzma', 'shlex',
+                       'socket', 'numpy', 'multiprocessing']:
+            self.assertNotIn(module, loaded_modules)
+
+    def test_singleEventConversion_expectWithinTimeBudget(self):
+        interpreter_time, conversion_time = self.time_python(
+            'pass', 'import hepmc2dot\nhepmc2dot.main([%r, %r])' % (self.hepmc_file, self.dot_file))
+        self.assertTrue(os.path.exists(self.dot_file))
+        self.assertLess(conversion_time, startup_time_budget * interpreter_time)
+
+
+class Test_serve(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+        self.hepmc_file = os.path.join(self.rundir, 'hepmc.txt')
+        with open(self.hepmc_file, 'w') as f:
+            f.writelines(decay_chain_event)
+        self.dot_file = os.path.join(self.rundir, 'graph.dot')
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def test_jobs_expectOneReplyPerJob(self):
+        jobs = StringIO('{0} {1}\n'
+                        '\n'
+                        '{0} {1} --seed 3\n'
+                        '{0}\n'
+                        '{2} {1}\n'.format(self.hepmc_file, self.dot_file,
+                                           os.path.join(self.rundir, 'missing.txt')))
+        replies = StringIO()
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertTrue(hepmc2dot.serve_jobs(jobs, replies))
+        finally:
+            sys.stderr = stderr
+        replies = replies.getvalue().splitlines()
+        self.assertEqual(['ok 1', 'ok 1', 'error invalid arguments'], replies[:3])
+        self.assertTrue(replies[3].startswith('error '))
+        self.assertEqual(4, len(replies))
+
+    def test_helpJob_expectHelpKeptOutOfReplies(self):
+        jobs = StringIO('-h\n')
+        replies = StringIO()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = replies, StringIO()
+        try:
+            self.assertTrue(hepmc2dot.serve_jobs(jobs, replies))
+            help_output = sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual('ok 0\n', replies.getvalue())
+        self.assertIn('usage:', help_output)
+
+    def test_quitJob_expectRemainingJobsIgnored(self):
+        jobs = StringIO('quit\n{0} {1}\n'.format(self.hepmc_file, self.dot_file))
+        replies = StringIO()
+        self.assertFalse(hepmc2dot.serve_jobs(jobs, replies))
+        self.assertEqual('', replies.getvalue())
+        self.assertFalse(os.path.exists(self.dot_file))
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+    def test_unixSocket_expectJobsConvertedUntilQuit(self):
+        socket_path = os.path.join(self.rundir, 'hepmc2dot.sock')
+        server = threading.Thread(target=hepmc2dot.serve, args=(socket_path,))
+        server.start()
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.01)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_path)
+        stream = client.makefile('rw')
+        stream.write('{0} {1}\n'.format(self.hepmc_file, self.dot_file))
+        stream.flush()
+        self.assertEqual('ok 1\n', stream.readline())
+        stream.write('quit\n')
+        stream.flush()
+        stream.close()
+        client.close()
+
+        server.join(5)
+        self.assertFalse(server.is_alive())
+        self.assertFalse(os.path.exists(socket_path))
+        self.assertTrue(os.path.exists(self.dot_file))
+
+    @unittest.skipIf(sys.platform.startswith('win'), 'needs select on pipes')
+    def test_stdinPipe_expectReplyBeforeInputCloses(self):
+        import select
+        server = subprocess.Popen([sys.executable, 'hepmc2dot.py', '--serve'], cwd=hepmc2dot_dir,
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            server.stdin.write('{0} {1}\n'.format(self.hepmc_file, self.dot_file).encode())
+            server.stdin.flush()
+            readable, _, _ = select.select([server.stdout], [], [], 10)
+            self.assertEqual([server.stdout], readable)
+            self.assertEqual(b'ok 1\n', server.stdout.readline())
+        finally:
+            server.stdin.close()
+            server.wait()
+            server.stdout.close()
+
+
+class Test_HepSubgraphWriter(unittest.TestCase):
+
+    def test_invalidWriterOptions_expectValueErrorAndCleanClose(self):
+        rundir = tempfile.mkdtemp()
+        try:
+            self.assertRaises(ValueError, hepmc2dot.HepSubgraphWriter,
+                              os.path.join(rundir, 'event_{event}.dot'), [3], per_event=True,
+                              events_per_file=2)
+            writer = hepmc2dot.HepSubgraphWriter.__new__(hepmc2dot.HepSubgraphWriter)
+            self.assertRaises(ValueError, writer.__init__,
+                              os.path.join(rundir, 'event_{event}.dot'), [3], per_event=True,
+                              events_per_file=2)
+            writer.close()
+        finally:
+            shutil.rmtree(rundir)